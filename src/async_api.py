@@ -0,0 +1,255 @@
+"""Non-blocking versions of the :mod:`client_api` calls.
+
+Each call here returns a :class:`Future` right away and runs the request on
+a small, shared pool of worker threads, so a caller can start several
+lookups and uploads at once and collect the results later, instead of
+creating a thread of its own for every operation. The objects that come
+back are the usual :class:`client_api.User`, :class:`client_api.Place`,
+:class:`client_api.Bind` and :class:`client_api.Position`, and requests
+still go through the pooled :mod:`transport`.
+
+The shared executor runs at most :attr:`Settings.POOL_MAXSIZE` calls at a
+time; the rest wait in line. The number of requests actually in flight is
+bounded by the transport, though: every request in the process, whether
+it comes from these workers, the outbox or a refresh thread, shares its
+pool of :attr:`Settings.POOL_MAXSIZE` connections to the server, and a
+request that finds them all busy blocks until one is free. So a call that
+has started may still wait for a connection.
+
+.. code-block:: python
+
+    import async_api, client_api
+    binds = async_api.get_binds()
+    place = async_api.get_place(3)
+    upload = async_api.post(client_api.Position(username='jceipek', bind=7))
+    place.add_done_callback(lambda future: show(future.result()))
+    print async_api.gather([binds, upload])
+
+"""
+
+import sys
+import threading
+from Queue import Queue
+
+import client_api
+from configuration import Settings
+
+
+class Future(object):
+    """The eventual result of a call running on the :class:`Executor`."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = list()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until the call has finished.
+
+        :returns: False if `timeout` ran out first
+        """
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """Wait for and return the result of the call, re-raising the
+        exception it raised, if any.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for the result")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the call to finish and return the exception it raised,
+        or None.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for the result")
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """Call `callback` with this future once the call has finished.
+        The callback runs on the worker thread that finished the call, or
+        right away if it already has; from Qt code, emit a signal in it to
+        get back to the GUI thread.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        _run_callback(callback, self)
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, list()
+        for callback in callbacks:
+            _run_callback(callback, self)
+
+
+class Executor(object):
+    """A fixed number of worker threads that run submitted calls in order.
+
+    :param max_workers: Number of calls that may run at the same time.
+        Their requests still share the connections of the
+        :mod:`transport`, so more workers than
+        :attr:`Settings.POOL_MAXSIZE` only means more threads waiting for
+        a connection.
+    :type max_workers: int
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._workers = list()
+        self._shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule ``func(*args, **kwargs)``.
+
+        :returns: :class:`Future`
+        """
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("The executor was shut down")
+            self._queue.put((future, func, args, kwargs))
+            # Workers are started on first use, so an idle client has none
+            if len(self._workers) < self.max_workers:
+                self._start_worker()
+        return future
+
+    def _start_worker(self):
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        worker.start()
+        self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, args, kwargs = item
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future._finish(exc_info=sys.exc_info())
+            else:
+                future._finish(result=result)
+
+    def shutdown(self, wait=True):
+        """Stop the workers once the calls already submitted have run."""
+        with self._lock:
+            self._shutdown = True
+            workers = list(self._workers)
+            for worker in workers:
+                self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """The executor shared by every call in this module, with
+    :attr:`Settings.POOL_MAXSIZE` workers.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = Executor(max_workers=Settings.POOL_MAXSIZE)
+        return _executor
+
+
+def submit(func, *args, **kwargs):
+    """Run any blocking call on the shared executor.
+
+    :returns: :class:`Future`
+    """
+    return get_executor().submit(func, *args, **kwargs)
+
+
+def gather(futures, timeout=None):
+    """Wait for all of `futures` and return their results in order. The
+    first exception raised by any of the calls is re-raised.
+    """
+    return [future.result(timeout) for future in futures]
+
+
+def post(sendable):
+    """Upload a new :class:`client_api.Place`, :class:`client_api.Bind` or
+    :class:`client_api.Position`. The future's result is the object
+    itself, with its `id` filled in.
+    """
+    return submit(_call_and_return, sendable.post, sendable)
+
+
+def put(sendable):
+    """Save changes to a :class:`client_api.User` or
+    :class:`client_api.Place`. The future's result is the object itself.
+    """
+    return submit(_call_and_return, sendable.put, sendable)
+
+
+def _call_and_return(method, value):
+    method()
+    return value
+
+
+def get_users(**crit):
+    return submit(client_api.get_users, **crit)
+
+
+def get_user(username):
+    return submit(client_api.get_user, username)
+
+
+def get_places(**crit):
+    return submit(client_api.get_places, **crit)
+
+
+def get_place(identifier):
+    return submit(client_api.get_place, identifier)
+
+
+def get_binds(**crit):
+    return submit(client_api.get_binds, **crit)
+
+
+def get_bind(identifier):
+    return submit(client_api.get_bind, identifier)
+
+
+def get_positions(**crit):
+    return submit(client_api.get_positions, **crit)
+
+
+def get_position(identifier):
+    return submit(client_api.get_position, identifier)
+
+
+def post_positions(positions):
+    return submit(client_api.post_positions, positions)
+
+
+def _run_callback(callback, future):
+    try:
+        callback(future)
+    except Exception as e:
+        print "Exception in a future's callback"
+        print e
@@ -0,0 +1,33 @@
+"""Replacing files in one step, so that a reader (or a crash half-way
+through) never sees half a file.
+
+.. code-block:: python
+
+    from atomicfile import atomic_write
+    with atomic_write('/tmp/report.json') as report_file:
+        json.dump(report, report_file)
+
+"""
+
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path):
+    """Write to a temporary file next to `path`, and rename it to `path`
+    once the ``with`` block is done. If the block raises, `path` is left
+    as it was.
+
+    :returns: The temporary file, open for writing
+    """
+    temporary_path = path + '.tmp'
+    try:
+        with open(temporary_path, 'w') as temporary_file:
+            yield temporary_file
+    except:
+        os.remove(temporary_path)
+        raise
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)  # rename doesn't replace files on Windows
+    os.rename(temporary_path, path)
@@ -1,22 +1,57 @@
 # http://islascruz.org/html/index.php/blog/show/Python%3A-Simple-HTTP-Server-on-python..html
 
-import os
+"""Signs the user in through the browser.
+
+:func:`authenticate` opens the sign-in page of the map in the browser and
+starts an :class:`AuthCallbackServer` on a free local port. Once the user
+has signed in, the page posts the session cookies to that server, which
+stores them in :attr:`Settings.COOKIES`.
+
+The server answers requests on their own threads, so a browser asking for
+``/favicon.ico`` (or keeping a connection open) doesn't hold up the
+callback, and it runs in the background until the cookies arrive or the
+deadline passes:
+
+.. code-block:: python
+
+    server = authserver.AuthCallbackServer().start()
+    webbrowser.open('%s/?port=%s' % (Settings.AUTH_ADDRESS, server.port))
+    cookies = server.wait(timeout=300)  # None if the user never signed in
+    server.stop()
+
+"""
+
 import cgi
-import sys
+import threading
 import webbrowser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 
 from configuration import Settings
 
+# Seconds to wait for the user to sign in
+AUTH_TIMEOUT = 300
+
+
 def auth_callback(cookies_dict):
     Settings.COOKIES = cookies_dict
 
+
 class MapAuthHTTPServer(BaseHTTPRequestHandler):
-	def do_GET(self):
-		self.send_response(200)
-		self.send_header('Content-type', 'text/html')
-		self.end_headers()
-		self.wfile.write('''
+    """Handles the requests made to the :class:`AuthCallbackServer`."""
+
+    # Drop connections the browser keeps open but doesn't use
+    timeout = 10
+
+    def do_GET(self):
+        if self.path != '/' and not self.path.startswith('/?'):
+            # i.e. /favicon.ico
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        self.end_headers()
+        self.wfile.write('''
 <html><body>
 <h1>Map auth debug</h1>
 <form method="post">
@@ -25,38 +60,135 @@ class MapAuthHTTPServer(BaseHTTPRequestHandler):
 </body></html>
 ''')
 
-	def do_POST(self):
-		length = int(self.headers.getheader('content-length'))
-		postvars = cgi.parse_qs(self.rfile.read(length), keep_blank_values=1)
-
-
-		self.send_response(303)
-		self.send_header('Location', Settings.WEB_ADDRESS)
-		self.end_headers()
-		self.wfile.write('User authenticated. Redirecting to the map.')
-
-		auth_callback({
-			"browserid": postvars.get('browserid', '')[0],
-			"session": postvars.get('session', '')[0]
-		})
-
-                #self.server.socket.close()
-
-def authenticate():
-    Settings.init()
-
-    server = HTTPServer(('', 0), MapAuthHTTPServer)
-
-    port = server.server_port
-
-    print "%s/?port=%s" % (Settings.AUTH_ADDRESS, port)
-
-    webbrowser.open("%s/?port=%s" %
-        (Settings.AUTH_ADDRESS, port))
-
-    print 'server started: http://localhost:' + str(port) + '/'
-    while not Settings.COOKIES:
-        server.handle_request()
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length'))
+        postvars = cgi.parse_qs(self.rfile.read(length), keep_blank_values=1)
+
+        self.send_response(303)
+        self.send_header('Location', Settings.WEB_ADDRESS)
+        self.end_headers()
+        self.wfile.write('User authenticated. Redirecting to the map.')
+
+        self.server.auth_server._received({
+            "browserid": postvars.get('browserid', [''])[0],
+            "session": postvars.get('session', [''])[0]
+        })
+
+    def log_message(self, format, *args):
+        # Every request would otherwise be printed to stderr
+        pass
+
+
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class AuthCallbackServer(object):
+    """A local HTTP server that waits for the sign-in page to post the
+    session cookies.
+
+    :param callback: Called with the cookies dict when they arrive, on the
+        thread that handled the request
+    :type callback: function
+    :param host: The interface to listen on
+    :type host: str
+    """
+
+    def __init__(self, callback=auth_callback, host='127.0.0.1'):
+        self.callback = callback
+        self.host = host
+        self.cookies = None
+        self._received_event = threading.Event()
+        self._finished = threading.Event()  # Cookies arrived or stopped
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        """The port the server listens on, chosen by the OS"""
+        return self._server.server_port
+
+    def start(self):
+        """Start serving on a background thread.
+
+        :returns: the server itself
+        """
+        self._server = _ThreadedHTTPServer((self.host, 0), MapAuthHTTPServer)
+        self._server.auth_server = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """Block until the cookies arrive, :meth:`stop` is called or
+        `timeout` seconds have passed.
+
+        :returns: The cookies dict, or None if they didn't arrive in time
+        """
+        self._finished.wait(timeout)
+        return self.cookies
+
+    @property
+    def received(self):
+        """True once the cookies have arrived"""
+        return self._received_event.is_set()
+
+    def stop(self):
+        """Stop serving and close the listening socket. Anyone blocked in
+        :meth:`wait` gives up right away, even if the server is only
+        started afterwards. Can be called from any thread.
+        """
+        with self._lock:
+            self._finished.set()
+            if self._server is None:
+                return
+            self._server.shutdown()
+            self._thread.join()
+            self._server.server_close()
+            self._server = None
+            self._thread = None
+
+    def _received(self, cookies):
+        if self._received_event.is_set():
+            return
+        self.cookies = cookies
+        try:
+            if self.callback is not None:
+                self.callback(cookies)
+        finally:
+            self._received_event.set()
+            self._finished.set()
+
+
+def authenticate(timeout=AUTH_TIMEOUT, server=None):
+    """Have the user sign in through the browser, and store the session
+    cookies in :attr:`Settings.COOKIES`. :meth:`Settings.init` must have
+    been called first.
+
+    :param timeout: Give up after this many seconds, or never if None
+    :type timeout: float
+    :param server: The server to wait on, not started yet. Pass one to be
+        able to give up early from another thread, by calling its
+        :meth:`AuthCallbackServer.stop`.
+    :type server: :class:`AuthCallbackServer`
+    :returns: True if the user signed in
+    """
+    if server is None:
+        server = AuthCallbackServer()
+    server.start()
+    try:
+        auth_url = "%s/?port=%s" % (Settings.AUTH_ADDRESS, server.port)
+        print auth_url
+        webbrowser.open(auth_url)
+
+        print 'server started: http://localhost:' + str(server.port) + '/'
+        return server.wait(timeout) is not None
+    finally:
+        server.stop()
 
 if __name__=='__main__':
-	main()
+    Settings.init()
+    if not authenticate():
+        print "Timed out waiting for the user to sign in"
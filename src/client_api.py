@@ -1,14 +1,31 @@
-import requests
 import json
 import urllib
 from copy import copy
 
 
 from configuration import Settings
+from transport import get_transport
+from metrics import request_metrics
+from memo import LRUCache, memoize
 
 class Unable_To_Connect_Error(Exception):
     pass
 
+class Bind_Rejected_Error(Exception):
+    """The server refused one bind of a :func:`post_binds` chunk."""
+    pass
+
+class Incomplete_Batch_Error(Exception):
+    """The server answered a batch upload for fewer objects than it was
+    sent."""
+    pass
+
+# Places, binds and users hardly ever change, so lookups by id are cached.
+# Anything this client changes or deletes is invalidated right away.
+_place_cache = LRUCache(maxsize=256, ttl=3600)
+_bind_cache = LRUCache(maxsize=1024, ttl=3600)
+_user_cache = LRUCache(maxsize=256, ttl=600)
+
 class _SendableObject(object):
     def __init__(self, init, attrs):
         super(_SendableObject, self).__setattr__('_attrs', attrs)
@@ -33,6 +50,19 @@ class _SendableObject(object):
     def __repr__(self):
         return "<%s:%s>" % (self.__class__.__name__, self._d)
 
+    def _update(self, new_values):
+        """Overwrite this object's fields in place with `new_values`.
+
+        :returns: True if any field changed
+        """
+        new_values = dict((key, value) for key, value in new_values.iteritems()
+                          if key in self._attrs)
+        if new_values == self._d:
+            return False
+        self._d.clear()
+        self._d.update(new_values)
+        return True
+
 class User(_SendableObject):
     """An object that represents a user that can be pulled from and pushed to
     the server.
@@ -56,11 +86,12 @@ class User(_SendableObject):
             raise KeyError("username not specified")
 
     def put(self):
-        r = requests.put(
+        r = get_transport().put(
                 '%s/users/%s' %
                 (Settings.SERVER_ADDRESS, self.username), data=self._d,
                 cookies=get_cookies()
                 )
+        get_user.invalidate(self.username)
 
 class Place(_SendableObject):
 
@@ -70,18 +101,20 @@ class Place(_SendableObject):
             setattr(self, key, value)
 
     def post(self):
-        r = requests.post(
+        r = get_transport().post(
             '%s/places/' % Settings.SERVER_ADDRESS, data=self._d,
             cookies=get_cookies()
             )
         response = json.loads(r.text)['place']
         self.id = response['id']
+        get_place.invalidate(self.id)
 
     def put(self):
-        r = requests.put(
+        r = get_transport().put(
             '%s/places/%s' % (Settings.SERVER_ADDRESS, self.id), data=self._d,
             cookies=get_cookies()
             )
+        get_place.invalidate(self.id)
         response = json.loads(r.text)['place']
 
 class Bind(_SendableObject):
@@ -100,20 +133,29 @@ class Bind(_SendableObject):
         for key, value in self._d.get('signals', dict()).iteritems():
             upload_dict['signals[%s]' % key] = value
 
-        place_id = upload_dict['place'].id
-        del upload_dict['place']
-        upload_dict['place'] = place_id
+        upload_dict['place'] = _place_id(upload_dict['place'])
 
         # Now upload_dict is the same as _d, but with the 'signals' key
         # replaced by keys of the form 'signals[MAC_ADDRESS]'
 
-        r = requests.post(
+        r = get_transport().post(
             '%s/binds/' % Settings.SERVER_ADDRESS, data=upload_dict,
             cookies=get_cookies()
             )
-        print r.text
         response = json.loads(r.text)['bind']
         self.id = response['id']
+        get_bind.invalidate(self.id)
+
+    def _json_dict(self):
+        upload_dict = copy(self._d)
+        upload_dict['place'] = _place_id(upload_dict['place'])
+        return upload_dict
+
+def _place_id(place):
+    # place can be either a Place or just its id
+    if isinstance(place, Place):
+        return place.id
+    return place
 
 class Position(_SendableObject):
     """
@@ -125,14 +167,17 @@ class Position(_SendableObject):
         for key, value in kargs.iteritems():
             setattr(self, key, value)
 
-    def post(self):
+    def _upload_dict(self):
         upload_dict = copy(self._d)
-        bind_id = upload_dict['bind'].id
-        del upload_dict['bind']
-        upload_dict['bind'] = bind_id
+        # bind can be either a Bind or just its id
+        if isinstance(upload_dict['bind'], Bind):
+            upload_dict['bind'] = upload_dict['bind'].id
+        return upload_dict
 
-        r = requests.post(
-                '%s/positions/' % Settings.SERVER_ADDRESS, data=upload_dict,
+    def post(self):
+        r = get_transport().post(
+                '%s/positions/' % Settings.SERVER_ADDRESS,
+                data=self._upload_dict(),
                 cookies=get_cookies()
                 )
         response = json.loads(r.text)['position']
@@ -143,55 +188,122 @@ def get_cookies():
     return Settings.COOKIES
 
 
+def get_cache_stats():
+    """Returns the hit/miss statistics of the place, bind and user caches.
+
+    :returns: dict of the form {'places': stats, 'binds': stats,
+        'users': stats}, where each stats dict comes from
+        :meth:`memo.LRUCache.stats`
+    """
+    return {'places': _place_cache.stats(),
+            'binds': _bind_cache.stats(),
+            'users': _user_cache.stats()}
+
+
+def invalidate_caches():
+    """Forget every cached place, bind and user."""
+    for cache in (_place_cache, _bind_cache, _user_cache):
+        cache.invalidate()
+
+
+def get_connection_stats():
+    """Returns how many HTTP connections were opened and how many
+    requests reused an existing keep-alive connection.
+    See :meth:`transport.Transport.stats`.
+    """
+    return get_transport().stats()
+
+
+def get_request_metrics():
+    """Returns the latency histogram, payload sizes, status codes and
+    retry count of every endpoint called so far.
+    See :meth:`metrics.RequestMetrics.snapshot`.
+    """
+    return request_metrics.snapshot()
+
+
 # returns an array of users that match a given criterion **crit
 # @param(**crit): the criterions. The ** will make crit a dictionary of the
 #   keyword arguments.
 def get_users(**crit):
-    r = requests.get(
+    r = get_transport().get(
         '%s/users/?%s' % (Settings.SERVER_ADDRESS, urllib.urlencode(crit)),
         cookies=get_cookies()
         )
     return [User(**user_dict) for user_dict in json.loads(r.text)['users']]
 
 # returns a particular user with the given username
+@memoize(_user_cache)
 def get_user(username):
+    from requests.exceptions import ConnectionError  # Imported on first use
+
     try:
-        r = requests.get(
+        r = get_transport().get(
                          '%s/users/%s' % (Settings.SERVER_ADDRESS,username),
                          cookies=get_cookies()
                          )
         user_dict = json.loads(r.text)['user']
         return User(**user_dict)
-    except requests.exceptions.ConnectionError:
+    except ConnectionError:
         raise Unable_To_Connect_Error
 
 
+def register_user(username, alias="Unknown"):
+    """Create the user on the server unless it already exists.
+    Problems are printed rather than raised, since the client can still
+    locate the user without being registered.
+
+    :returns: True if the user exists on the server now
+    """
+    try:
+        get_user(username)
+        return True
+    except Unable_To_Connect_Error:
+        print "Unable to connect to marauder's map server"
+    except KeyError:
+        print "User not found on server. Posting."
+        print "Making User"
+        try:
+            User(username=username, alias=alias).put()
+            return True
+        except Exception as e:
+            print "Failed to register user"
+            print e
+    except Exception as e:
+        print "Failed to look up user"
+        print e
+    return False
+
+
 def delete_user(username):
-    r = requests.delete(
+    r = get_transport().delete(
         '%s/users/%s' % (Settings.SERVER_ADDRESS, username),
         cookies=get_cookies()
         )
+    get_user.invalidate(username)
     return r.text
 
 # Places
 
 def get_places(**crit):
-    r = requests.get(
+    r = get_transport().get(
         '%s/places/?%s' % (Settings.SERVER_ADDRESS, urllib.urlencode(crit)),
         cookies=get_cookies())
     return [Place(**place_dict) for place_dict in json.loads(r.text)['places']]
 
+@memoize(_place_cache)
 def get_place(identifier):
-    r = requests.get(
+    r = get_transport().get(
         '%s/places/%s' % (Settings.SERVER_ADDRESS, identifier),
         cookies=get_cookies())
     place_dict = json.loads(r.text)['place']
     return Place(**place_dict)
 
 def delete_place(identifier):
-    r = requests.delete(
+    r = get_transport().delete(
         '%s/places/%s' % (Settings.SERVER_ADDRESS, identifier),
         cookies=get_cookies())
+    get_place.invalidate(identifier)
     return r.text
 
 # Binds
@@ -221,35 +333,167 @@ def get_binds(**crit):
     # Now upload_dict is the same as before, but with the 'nearest' key
     # replaced by keys of the form 'nearest[MAC_ADDRESS]'
 
-    r = requests.get(
+    r = get_transport().get(
         '%s/binds/?%s' % (Settings.SERVER_ADDRESS, urllib.urlencode(upload_dict)),
         cookies=get_cookies())
     return [Bind(**bind_dict) for bind_dict in json.loads(r.text)['binds']]
 
+@memoize(_bind_cache)
 def get_bind(identifier):
-    r = requests.get(
+    r = get_transport().get(
             '%s/binds/%s' % (Settings.SERVER_ADDRESS, identifier),
             cookies=get_cookies())
     bind_dict = json.loads(r.text)['bind']
     return Bind(**bind_dict)
 
 def delete_bind(identifier):
-    r = requests.delete(
+    r = get_transport().delete(
             '%s/binds/%s' % (Settings.SERVER_ADDRESS, identifier),
             cookies=get_cookies())
+    get_bind.invalidate(identifier)
     return r.text
 
+# Servers without the batch endpoint answer 404 or 405; after that,
+# post_binds sends binds one at a time instead.
+_binds_batch_supported = True
+
+def post_binds(binds, chunk_size=100, max_in_flight=2):
+    """Upload many binds at once, i.e. the fingerprints of a survey.
+
+    The binds are sent to ``/binds/batch`` in chunks of `chunk_size`, with
+    JSON bodies of the form ``{"binds": [{"username": ..., "place": ...,
+    "signals": {MAC_ADDRESS: strength, ...}, "x": ..., "y": ...}, ...]}``,
+    and up to `max_in_flight` chunks are uploaded at the same time. If the
+    server does not support batches, every bind is posted on its own.
+
+    Binds that already have an `id` are skipped, so after a partial
+    failure, calling :func:`post_binds` again with the same list only
+    uploads the binds that are still missing.
+
+    :param binds: The binds to upload. Their ids are set as they succeed.
+    :type binds: list of :class:`Bind`
+    :returns: list of (bind, exception) tuples, one for every bind that
+        could not be uploaded
+    """
+    import async_api  # async_api imports this module
+
+    pending = [bind for bind in binds if bind._d.get('id') is None]
+    chunks = [pending[start:start + chunk_size]
+              for start in xrange(0, len(pending), chunk_size)]
+    executor = async_api.Executor(max_workers=max_in_flight)
+    try:
+        uploads = [executor.submit(_post_bind_chunk, chunk) for chunk in chunks]
+        failures = list()
+        for chunk, upload in zip(chunks, uploads):
+            error = upload.exception()
+            if error is None:
+                failures.extend(upload.result())
+            else:
+                failures.extend((bind, error) for bind in chunk
+                                if bind._d.get('id') is None)
+    finally:
+        executor.shutdown(wait=False)
+    return failures
+
+def _post_bind_chunk(chunk):
+    global _binds_batch_supported
+
+    if _binds_batch_supported:
+        r = get_transport().post(
+            '%s/binds/batch' % Settings.SERVER_ADDRESS,
+            data=json.dumps({'binds': [bind._json_dict() for bind in chunk]}),
+            headers={'Content-Type': 'application/json'},
+            cookies=get_cookies())
+        if r.status_code in (404, 405):
+            _binds_batch_supported = False
+        else:
+            r.raise_for_status()
+            responses = json.loads(r.text)['binds']
+            failures = list()
+            for bind, response in zip(chunk, responses):
+                if 'id' in response:
+                    bind.id = response['id']
+                else:
+                    failures.append((bind, Bind_Rejected_Error(
+                        response.get('error', 'rejected by the server'))))
+            if len(responses) < len(chunk):
+                # The binds the server didn't answer for have no id
+                error = Incomplete_Batch_Error(
+                    "The server answered for %i of %i binds" %
+                    (len(responses), len(chunk)))
+                failures.extend((bind, error) for bind in chunk[len(responses):]
+                                if bind._d.get('id') is None)
+            return failures
+
+    failures = list()
+    for bind in chunk:
+        try:
+            bind.post()
+        except Exception as e:
+            failures.append((bind, e))
+    return failures
+
 # Positions
 
 def get_positions(**crit):
-    r = requests.get(
+    r = get_transport().get(
         '%s/positions/?%s' %
         (Settings.SERVER_ADDRESS, urllib.urlencode(crit)),
         cookies=get_cookies())
     return [Position(**position_dict) for position_dict in json.loads(r.text)['positions']]
 
+# Servers without the batch endpoint answer 404 or 405; after that,
+# post_positions sends positions one at a time instead.
+_positions_batch_supported = True
+
+def post_positions(positions):
+    """Upload several positions in a single request to
+    ``/positions/batch``, with a JSON body of the form
+    ``{"positions": [{"username": ..., "bind": ...}, ...]}``.
+
+    Falls back to one :meth:`Position.post` per position if the server
+    does not support batches. Positions that already have an `id` are
+    skipped, so after a partial failure, calling :func:`post_positions`
+    again with the same list only uploads the ones that are still missing.
+
+    :param positions: The positions to upload. Their ids are set once
+        the upload succeeds.
+    :type positions: list of :class:`Position`
+    :raises Incomplete_Batch_Error: if the server answered for fewer
+        positions than it was sent; only the ones it answered for get ids
+    """
+    global _positions_batch_supported
+    positions = [position for position in positions
+                 if position._d.get('id') is None]
+    if not positions:
+        return
+
+    if _positions_batch_supported:
+        r = get_transport().post(
+            '%s/positions/batch' % Settings.SERVER_ADDRESS,
+            data=json.dumps({'positions': [position._upload_dict()
+                                           for position in positions]}),
+            headers={'Content-Type': 'application/json'},
+            cookies=get_cookies())
+        if r.status_code in (404, 405):
+            _positions_batch_supported = False
+        else:
+            r.raise_for_status()
+            responses = json.loads(r.text)['positions']
+            for position, response in zip(positions, responses):
+                position.id = response['id']
+            if len(responses) < len(positions):
+                # The positions without an id are left for the caller to retry
+                raise Incomplete_Batch_Error(
+                    "The server answered for %i of %i positions" %
+                    (len(responses), len(positions)))
+            return
+
+    for position in positions:
+        position.post()
+
 def get_position(identifier):
-    r = requests.get(
+    r = get_transport().get(
         '%s/positions/%s' % (Settings.SERVER_ADDRESS, identifier),
         cookies=get_cookies())
     position_dict = json.loads(r.text)['position']
@@ -258,7 +502,7 @@ def get_position(identifier):
 
 
 def delete_position(identifier):
-    r = requests.delete(
+    r = get_transport().delete(
         '%s/positions/%s' % (Settings.SERVER_ADDRESS, identifier),
         cookies=get_cookies())
     return r.text
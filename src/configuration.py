@@ -1,8 +1,13 @@
 import os
 import appdirs
+import atexit
 import json
+import threading
+import time
 import ConfigParser
 
+from atomicfile import atomic_write
+
 class Undefined_Value_Error(Exception):
     pass
 
@@ -53,11 +58,72 @@ class Settings(object):
         * **AUTH_ADDRESS** (str) - Web address of auth server; used on
             first launch
 
-        * **REFRESH_FREQ** (float) - How often to refresh the location, in
-            seconds
+        * **REFRESH_FREQ** (float) - The longest time between two location
+            refreshes, in seconds. The location is refreshed sooner if the
+            signal strengths change by more than DRIFT_THRESHOLD
 
             Default: ``300``
 
+        * **POOL_CONNECTIONS** (int) - Number of per-host HTTP connection
+            pools kept by :mod:`transport`
+
+            Default: ``2``
+
+        * **POOL_MAXSIZE** (int) - Maximum number of keep-alive HTTP
+            connections to a single host
+
+            Default: ``4``
+
+        * **CACHE_TTL** (float) - How long binds and places cached on disk
+            are used before they are revalidated with the server, in seconds
+
+            Default: ``600``
+
+        * **HEARTBEAT_FREQ** (float) - How often to upload the location
+            even if it has not changed, in seconds
+
+            Default: ``1800``
+
+        * **SCAN_BACKEND** (str) - Name of the
+            :mod:`signal_strength` backend used to scan for access points,
+            or ``auto`` to pick the one for the current platform (or
+            ``shared`` if a :mod:`scanhost` is running)
+
+            Default: ``auto``
+
+        * **SCAN_REPLAY_PATH** (str) - File or directory of recorded scans
+            played back by the ``replay`` backend
+
+        * **SCAN_REPLAY_INTERVAL** (float) - Seconds between two scans
+            played back by the ``replay`` backend
+
+            Default: ``1``
+
+        * **SCAN_SHARED_PATH** (str) - Unix socket of the
+            :class:`scanhost.ScanHost` used by the ``shared`` backend;
+            empty for the default location under /run. Its directory must
+            belong to root or the user, and nobody else may write to it.
+
+        * **SCAN_INTERVAL** (float) - How often the background scanner
+            scans for access points, in seconds
+
+            Default: ``10``
+
+        * **DRIFT_THRESHOLD** (float) - How far the signal strengths must
+            drift (root mean square) from those at the last refresh before
+            the location is refreshed again
+
+            Default: ``10``
+
+        * **METRICS_DUMP_FREQ** (float) - How often to write the request
+            statistics of :mod:`metrics` to ``metrics.json`` in DATA_DIR,
+            in seconds; ``0`` turns this off
+
+            Default: ``0``
+
+        * **DATA_DIR** (str) - The per-user directory that holds
+            ``config.txt`` and the caches (read only)
+
     """
 
     _READY = False  # Has init() been called?
@@ -75,12 +141,60 @@ class Settings(object):
                  'What website to use for authentication'),
             "REFRESH_FREQ": '%i ; %s' %
                 (300,
-                 'How often to refresh the location, in seconds')
+                 'How often to refresh the location, in seconds'),
+            "POOL_CONNECTIONS": '%i ; %s' %
+                (2,
+                 'Number of per-host HTTP connection pools to keep'),
+            "POOL_MAXSIZE": '%i ; %s' %
+                (4,
+                 'Maximum number of open HTTP connections per host'),
+            "CACHE_TTL": '%i ; %s' %
+                (600,
+                 'How long cached binds and places are trusted, in seconds'),
+            "HEARTBEAT_FREQ": '%i ; %s' %
+                (1800,
+                 'How often to resend an unchanged location, in seconds'),
+            "SCAN_BACKEND": '%s ; %s' %
+                ('auto',
+                 'How to scan for access points (auto, network_manager, '
+                 'airport, windows, replay or shared)'),
+            "SCAN_REPLAY_PATH": '%s ; %s' %
+                ('',
+                 'Recorded scans to play back with the replay backend'),
+            "SCAN_REPLAY_INTERVAL": '%i ; %s' %
+                (1,
+                 'Seconds between two scans played back by the replay backend'),
+            "SCAN_SHARED_PATH": '%s ; %s' %
+                ('',
+                 'Socket of the shared scanner (empty for the default)'),
+            "SCAN_INTERVAL": '%i ; %s' %
+                (10,
+                 'How often to scan for access points in the background, '
+                 'in seconds'),
+            "DRIFT_THRESHOLD": '%i ; %s' %
+                (10,
+                 'How much the signal strengths must change before the '
+                 'location is refreshed'),
+            "METRICS_DUMP_FREQ": '%i ; %s' %
+                (0,
+                 'How often to write request statistics to metrics.json, '
+                 'in seconds (0 to turn off)')
             }
 
     APP_NAME = "MaraudersMap"  # Used to define prefs path
     APP_AUTHOR = "ohack"  # Used to define prefs path
 
+    # Changes are written to config.txt once no other change has been made
+    # for this many seconds, i.e. after the user lets go of a slider
+    WRITE_DELAY = 1.0
+
+    # Guards _config_parser and _snapshot, which worker threads read too
+    _lock = threading.RLock()
+    _snapshot = {}  # key -> parsed value, filled in on first use
+    _write_timer = None
+    _dirty = False
+    _last_change = 0
+
     @classmethod
     def init(cls):
         """Call this before using Settings. Calling it multiple times
@@ -101,8 +215,10 @@ class Settings(object):
         cls._prefs_file_path = os.path.join(cls._prefs_dir, "config.txt")
         cls._secret_file_path = os.path.join(cls._prefs_dir, "secret")
 
-        cls._config_parser = ConfigParser.RawConfigParser(cls._DEFAULTS)
-        cls._config_parser.add_section('User Defined')
+        with cls._lock:
+            cls._config_parser = ConfigParser.RawConfigParser(cls._DEFAULTS)
+            cls._config_parser.add_section('User Defined')
+            cls._snapshot = {}
 
         # Create the preferences directory if necessary
         if not os.path.isdir(cls._prefs_dir):
@@ -132,18 +248,65 @@ class Settings(object):
         else:
             cls._read_secret_from_file()
 
+        if not cls._READY:
+            atexit.register(cls.flush)
         cls._READY = True
 
     @classmethod
     def write_prefs_to_file(cls):
-        """Writes preferences to file. You shouldn't need to call this
-        manually because it gets called every time a setting is changed.
+        """Writes preferences to file right away. You shouldn't need to
+        call this manually because changed settings are written
+        :attr:`WRITE_DELAY` seconds after the last change, and on exit
+        (see :meth:`flush`).
+
+        The file is written under a temporary name and then renamed, so it
+        is never left half-written.
 
         .. note:: Every time this method is called, all comments in the
             file will be overwritten (with rare exceptions)
         """
-        with open(cls._prefs_file_path, 'w') as prefs_file:
-            cls._config_parser.write(prefs_file)
+        with cls._lock:
+            with atomic_write(cls._prefs_file_path) as prefs_file:
+                cls._config_parser.write(prefs_file)
+            cls._dirty = False
+
+    @classmethod
+    def flush(cls):
+        """Write changed settings to file now instead of waiting for
+        :attr:`WRITE_DELAY` to pass. Called automatically on exit.
+        """
+        with cls._lock:
+            if cls._write_timer is not None:
+                cls._write_timer.cancel()
+                cls._write_timer = None
+            if cls._dirty:
+                cls.write_prefs_to_file()
+
+    @classmethod
+    def _schedule_write(cls):
+        with cls._lock:
+            cls._dirty = True
+            cls._last_change = time.time()
+            if cls._write_timer is None:
+                cls._start_write_timer(cls.WRITE_DELAY)
+
+    @classmethod
+    def _start_write_timer(cls, delay):
+        cls._write_timer = threading.Timer(delay, cls._write_when_idle)
+        cls._write_timer.daemon = True
+        cls._write_timer.start()
+
+    @classmethod
+    def _write_when_idle(cls):
+        with cls._lock:
+            idle = time.time() - cls._last_change
+            if idle < cls.WRITE_DELAY:
+                # Changed again in the meantime; wait some more
+                cls._start_write_timer(cls.WRITE_DELAY - idle)
+                return
+            cls._write_timer = None
+            if cls._dirty:
+                cls.write_prefs_to_file()
 
     @classmethod
     def read_prefs_from_file(cls):
@@ -152,8 +315,10 @@ class Settings(object):
         want to support users who modify the file while the application is
         running.
         """
-        with open(cls._prefs_file_path) as prefs_file:
-            cls._config_parser.readfp(prefs_file)
+        with cls._lock:
+            with open(cls._prefs_file_path) as prefs_file:
+                cls._config_parser.readfp(prefs_file)
+            cls._snapshot = {}
 
     @classmethod
     def _read_secret_from_file(cls):
@@ -190,6 +355,38 @@ class Settings(object):
         except ConfigParser.NoOptionError:
             raise Undefined_Value_Error
 
+    @classmethod
+    def _get_value(cls, key, parse=None):
+        """The value of setting `key` without its comment, converted with
+        `parse`. The file is only parsed the first time a setting is read;
+        after that the value comes from a snapshot in memory.
+        """
+        cls._check_for_init()
+        try:
+            return cls._snapshot[key]
+        except KeyError:
+            pass
+        with cls._lock:
+            value = cls._get_raw_user_defined_value(key).split(';')[0].strip()
+            if parse is not None:
+                value = parse(value)
+            cls._snapshot[key] = value
+            return value
+
+    @classmethod
+    def _set_value(cls, key, value):
+        """Change setting `key`. The file is written a little later, so
+        that many changes in a row cost a single write.
+        """
+        cls._check_for_init()
+        with cls._lock:
+            if not isinstance(value, basestring):
+                value = str(value)
+            cls._set_raw_user_defined_value(key, value)
+            # Parsed again on the next read, with the getter's type
+            cls._snapshot.pop(key, None)
+        cls._schedule_write()
+
     class __metaclass__(type):
         """Define custom class properties (getters and setters)
         Code from: http://stackoverflow.com/a/1800999/798235
@@ -219,82 +416,145 @@ class Settings(object):
 
         @property
         def AUTH_ADDRESS(cls):
-            cls._check_for_init()
-            raw_value = cls._get_raw_user_defined_value('AUTH_ADDRESS')
-            return raw_value.split(';')[0].strip()
+            return cls._get_value('AUTH_ADDRESS')
 
         @AUTH_ADDRESS.setter
         def AUTH_ADDRESS(cls, value):
-            cls._check_for_init()
-            raw_value = cls._set_raw_user_defined_value('AUTH_ADDRESS',
-                                                        value)
-            cls.write_prefs_to_file()
+            cls._set_value('AUTH_ADDRESS', value)
 
 
         @property
         def SERVER_ADDRESS(cls):
-            cls._check_for_init()
-            raw_value = cls._get_raw_user_defined_value('SERVER_ADDRESS')
-            return raw_value.split(';')[0].strip()
+            return cls._get_value('SERVER_ADDRESS')
 
         @SERVER_ADDRESS.setter
         def SERVER_ADDRESS(cls, value):
-            cls._check_for_init()
-            raw_value = cls._set_raw_user_defined_value('SERVER_ADDRESS',
-                                                        value)
-            cls.write_prefs_to_file()
+            cls._set_value('SERVER_ADDRESS', value)
 
         @property
         def WEB_ADDRESS(cls):
-            cls._check_for_init()
-            raw_value = cls._get_raw_user_defined_value('WEB_ADDRESS')
-            return raw_value.split(';')[0].strip()
+            return cls._get_value('WEB_ADDRESS')
 
         @WEB_ADDRESS.setter
         def WEB_ADDRESS(cls, value):
-            cls._check_for_init()
-            raw_value = cls._set_raw_user_defined_value('WEB_ADDRESS',
-                                                        value)
-            cls.write_prefs_to_file()
+            cls._set_value('WEB_ADDRESS', value)
 
         @property
         def REFRESH_FREQ(cls):
-            cls._check_for_init()
-            raw_value = cls._get_raw_user_defined_value('REFRESH_FREQ')
-            return float(raw_value.split(';')[0].strip())
+            return cls._get_value('REFRESH_FREQ', float)
 
         @REFRESH_FREQ.setter
         def REFRESH_FREQ(cls, value):
+            cls._set_value('REFRESH_FREQ', value)
+
+        @property
+        def POOL_CONNECTIONS(cls):
+            return cls._get_value('POOL_CONNECTIONS', int)
+
+        @POOL_CONNECTIONS.setter
+        def POOL_CONNECTIONS(cls, value):
+            cls._set_value('POOL_CONNECTIONS', value)
+
+        @property
+        def POOL_MAXSIZE(cls):
+            return cls._get_value('POOL_MAXSIZE', int)
+
+        @POOL_MAXSIZE.setter
+        def POOL_MAXSIZE(cls, value):
+            cls._set_value('POOL_MAXSIZE', value)
+
+        @property
+        def CACHE_TTL(cls):
+            return cls._get_value('CACHE_TTL', float)
+
+        @CACHE_TTL.setter
+        def CACHE_TTL(cls, value):
+            cls._set_value('CACHE_TTL', value)
+
+        @property
+        def HEARTBEAT_FREQ(cls):
+            return cls._get_value('HEARTBEAT_FREQ', float)
+
+        @HEARTBEAT_FREQ.setter
+        def HEARTBEAT_FREQ(cls, value):
+            cls._set_value('HEARTBEAT_FREQ', value)
+
+        @property
+        def SCAN_BACKEND(cls):
+            return cls._get_value('SCAN_BACKEND')
+
+        @SCAN_BACKEND.setter
+        def SCAN_BACKEND(cls, value):
+            cls._set_value('SCAN_BACKEND', value)
+
+        @property
+        def SCAN_REPLAY_PATH(cls):
+            return cls._get_value('SCAN_REPLAY_PATH')
+
+        @SCAN_REPLAY_PATH.setter
+        def SCAN_REPLAY_PATH(cls, value):
+            cls._set_value('SCAN_REPLAY_PATH', value)
+
+        @property
+        def SCAN_REPLAY_INTERVAL(cls):
+            return cls._get_value('SCAN_REPLAY_INTERVAL', float)
+
+        @SCAN_REPLAY_INTERVAL.setter
+        def SCAN_REPLAY_INTERVAL(cls, value):
+            cls._set_value('SCAN_REPLAY_INTERVAL', value)
+
+        @property
+        def SCAN_SHARED_PATH(cls):
+            return cls._get_value('SCAN_SHARED_PATH')
+
+        @SCAN_SHARED_PATH.setter
+        def SCAN_SHARED_PATH(cls, value):
+            cls._set_value('SCAN_SHARED_PATH', value)
+
+        @property
+        def SCAN_INTERVAL(cls):
+            return cls._get_value('SCAN_INTERVAL', float)
+
+        @SCAN_INTERVAL.setter
+        def SCAN_INTERVAL(cls, value):
+            cls._set_value('SCAN_INTERVAL', value)
+
+        @property
+        def DRIFT_THRESHOLD(cls):
+            return cls._get_value('DRIFT_THRESHOLD', float)
+
+        @DRIFT_THRESHOLD.setter
+        def DRIFT_THRESHOLD(cls, value):
+            cls._set_value('DRIFT_THRESHOLD', value)
+
+        @property
+        def METRICS_DUMP_FREQ(cls):
+            return cls._get_value('METRICS_DUMP_FREQ', float)
+
+        @METRICS_DUMP_FREQ.setter
+        def METRICS_DUMP_FREQ(cls, value):
+            cls._set_value('METRICS_DUMP_FREQ', value)
+
+        @property
+        def DATA_DIR(cls):
             cls._check_for_init()
-            raw_value = cls._set_raw_user_defined_value('REFRESH_FREQ',
-                                                        value)
-            cls.write_prefs_to_file()
+            return cls._prefs_dir
 
         @property
         def USER_NAME(cls):
-            cls._check_for_init()
-            raw_value = cls._get_raw_user_defined_value('USER_NAME')
-            return raw_value.split(';')[0].strip()
+            return cls._get_value('USER_NAME')
 
         @USER_NAME.setter
         def USER_NAME(cls, value):
-            cls._check_for_init()
-            raw_value = cls._set_raw_user_defined_value('USER_NAME',
-                                                        value)
-            cls.write_prefs_to_file()
+            cls._set_value('USER_NAME', value)
 
         @property
         def FULL_USER_NAME(cls):
-            cls._check_for_init()
-            raw_value = cls._get_raw_user_defined_value('FULL_USER_NAME')
-            return raw_value.split(';')[0].strip()
+            return cls._get_value('FULL_USER_NAME')
 
         @FULL_USER_NAME.setter
         def FULL_USER_NAME(cls, value):
-            cls._check_for_init()
-            raw_value = cls._set_raw_user_defined_value('FULL_USER_NAME',
-                                                        value)
-            cls.write_prefs_to_file()
+            cls._set_value('FULL_USER_NAME', value)
 
 if __name__ == "__main__":
     Settings.init()
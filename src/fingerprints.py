@@ -0,0 +1,131 @@
+"""Client-side nearest-bind search.
+
+Instead of asking the server for the bind nearest to the current signal
+readings on every refresh, download all of the binds once and keep their
+signal strengths in a matrix with one row per bind and one column per
+BSSID. Finding the nearest bind is then a single vectorized distance
+computation.
+
+.. code-block:: python
+
+    import client_api, fingerprints, signal_strength
+    index = fingerprints.FingerprintIndex(client_api.get_binds())
+    signals = signal_strength.get_avg_signals_dict()
+    likeliest_bind = index.nearest(signals, limit=1)[0]
+
+"""
+
+# numpy is only imported once an index has binds to hold
+from signal_strength import numpy
+
+
+class FingerprintIndex(object):
+    """An in-memory index of the signal fingerprints of a set of binds.
+
+    An access point that is missing from a fingerprint is treated as having
+    a signal strength of 0, which is what :mod:`signal_strength` reports for
+    an access point that is out of range.
+
+    The index can be rebuilt from another thread while it is being
+    searched; a search always sees either the old or the new set of binds.
+
+    :param binds: The binds to index
+    :type binds: iterable of :class:`client_api.Bind`
+    """
+
+    def __init__(self, binds=()):
+        self._state = ({}, None, [])
+        self.rebuild(binds)
+
+    def rebuild(self, binds):
+        """Replace the contents of the index with `binds`.
+        Binds without signal readings are skipped.
+        """
+        rows = list()
+        for bind in binds:
+            signals = _signals_of(bind)
+            if signals:
+                rows.append((bind, signals))
+        if not rows:
+            self._state = ({}, None, [])
+            return
+
+        bssids = set()
+        for bind, signals in rows:
+            bssids.update(signals)
+        columns = dict((bssid, col) for col, bssid in enumerate(sorted(bssids)))
+
+        matrix = numpy.zeros((len(rows), len(columns)), dtype=numpy.float32)
+        for row, (bind, signals) in enumerate(rows):
+            for bssid, strength in signals.iteritems():
+                matrix[row, columns[bssid]] = float(strength)
+
+        # Swap everything in at once so that concurrent searches stay consistent
+        self._state = (columns, matrix, [bind for bind, signals in rows])
+
+    def __len__(self):
+        return len(self._state[2])
+
+    @property
+    def bssids(self):
+        """The BSSIDs that make up the columns of the index"""
+        columns = self._state[0]
+        return sorted(columns, key=columns.get)
+
+    def nearest(self, signals, limit=1):
+        """Get the binds whose fingerprints are closest to `signals`.
+
+        :param signals: dict of the form {MAC_AddressSTR : signal_strengthINT }
+            as returned by :func:`signal_strength.get_avg_signals_dict`
+        :type signals: dict
+        :param limit: Maximum number of binds to return
+        :type limit: int
+
+        :returns: list of :class:`client_api.Bind` objects, nearest first
+        """
+        columns, matrix, binds = self._state
+        if not binds:
+            return []
+
+        query = numpy.zeros(len(columns), dtype=numpy.float32)
+        for bssid, strength in signals.iteritems():
+            col = columns.get(bssid)
+            # Access points that no bind has ever seen add the same amount to
+            # every distance, so they can't change the ranking
+            if col is not None:
+                query[col] = float(strength)
+
+        distances = numpy.square(matrix - query).sum(axis=1)
+        if limit >= len(binds):
+            order = numpy.argsort(distances)
+        else:
+            nearest = numpy.argpartition(distances, limit)[:limit]
+            order = nearest[numpy.argsort(distances[nearest])]
+        return [binds[i] for i in order]
+
+
+def fingerprint_distance(signals_a, signals_b):
+    """Root mean square difference between two sets of signal readings,
+    counting an access point that is missing from one of them as 0.
+
+    :param signals_a: dict of the form {MAC_AddressSTR : signal_strengthINT }
+    :type signals_a: dict
+    :param signals_b: dict of the form {MAC_AddressSTR : signal_strengthINT }
+    :type signals_b: dict
+    :returns: float
+    """
+    bssids = set(signals_a) | set(signals_b)
+    if not bssids:
+        return 0.0
+    total = 0.0
+    for bssid in bssids:
+        difference = signals_a.get(bssid, 0) - signals_b.get(bssid, 0)
+        total += difference * difference
+    return (total / len(bssids)) ** 0.5
+
+
+def _signals_of(bind):
+    try:
+        return bind.signals
+    except KeyError:
+        return None
@@ -0,0 +1,237 @@
+"""Runs the location loop without Qt, i.e. as a daemon on shared lab
+machines without a system tray.
+
+The loop is the same as the tray application's: a
+:class:`signal_strength.ScanService` scans in the background, an
+:class:`scheduler.AdaptiveScheduler` decides when the user has moved, and
+a :class:`locator.Locator` finds the nearest bind and queues the position
+in a :class:`outbox.PositionOutbox`. Only PySide is left out, so the
+daemon starts faster and uses much less memory.
+
+Start it with::
+
+    python headless.py
+
+It is controlled with POSIX signals:
+
+* **SIGTERM** or **SIGINT** - upload whatever is waiting and exit
+* **SIGHUP** - re-read ``config.txt``
+* **SIGUSR1** - refresh the location right away
+
+or by writing one command per line to the Unix socket ``daemon.sock`` in
+:attr:`Settings.DATA_DIR`; every command is answered with a line of JSON.
+The commands are ``status``, ``refresh``, ``online``, ``offline`` and
+``stop``. The socket needs a Unix-like system, such as Linux::
+
+    python headless.py send status
+
+"""
+
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from getpass import getuser
+
+import client_api
+import locator
+import outbox
+import sync
+import unixsocket
+from configuration import Settings, Undefined_Value_Error
+
+
+class LocationDaemon(object):
+    """The scan, locate and upload loop (a :class:`locator.LocationLoop`),
+    with the state that the tray application keeps in its preferences
+    window.
+
+    :param control_path: Where to listen for commands, or None to only
+        be controlled with signals
+    :type control_path: str
+    :raises outbox.Outbox_In_Use_Error: if the tray application or another
+        daemon of this user is running
+    """
+
+    def __init__(self, control_path=None):
+        self.control_path = control_path
+        self.is_online = True
+        self.place = None  # The place found by the last refresh
+        self.last_refresh = None
+        self._stopping = False
+        self._wake = threading.Event()
+        self._control_server = None
+        self.location_loop = locator.LocationLoop(
+            username=Settings.USER_NAME,
+            outbox_path=os.path.join(Settings.DATA_DIR, 'outbox.jsonl'))
+
+    def run(self):
+        """Run the loop on the calling thread until :meth:`stop` is
+        called.
+
+        :raises unixsocket.Socket_In_Use_Error: if another daemon is
+            listening on `control_path`
+        """
+        try:
+            if self.control_path is not None:
+                self._control_server = unixsocket.LineServer(
+                    self.control_path, self.handle_command).start()
+            self.location_loop.start()
+            # Locate right away once the first scan is in
+            self.location_loop.request_refresh()
+            while not self._stopping:
+                self._step()
+                # A short timeout keeps signal handlers responsive, since
+                # Python 2 only runs them between bytecodes
+                deadline = time.time() + self.location_loop.next_interval
+                while not self._stopping and not self._wake.is_set():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._wake.wait(min(remaining, 1.0))
+                self._wake.clear()
+        finally:
+            self._shut_down()
+
+    def _step(self):
+        # Waiting for the first scan here rather than in the locator
+        # leaves the loop free to stop in between
+        if self.is_online and self.location_loop.check(timeout=5):
+            self.refresh()
+
+    def refresh(self):
+        try:
+            place = self.location_loop.refresh()
+        except Exception as e:
+            print "Failed to refresh the location"
+            print e
+            return
+        self.last_refresh = time.time()
+        if place is not None:
+            self.place = place
+            print "I'm at %s" % place
+        else:
+            print "No nearest binds found"
+
+    def request_refresh(self):
+        self.location_loop.request_refresh()
+        self._wake.set()
+
+    def go_online(self):
+        self.is_online = True
+        self.request_refresh()
+
+    def go_offline(self):
+        self.is_online = False
+
+    def stop(self):
+        """Make :meth:`run` return. Safe to call from signal handlers and
+        other threads.
+        """
+        self._stopping = True
+        self._wake.set()
+
+    def status(self):
+        """:returns: dict describing what the daemon is doing"""
+        place = None
+        if self.place is not None:
+            place = self.place._d
+        return {'online': self.is_online,
+                'place': place,
+                'last_refresh': self.last_refresh,
+                'positions_waiting': len(self.location_loop.position_outbox),
+                'scanning_every': self.location_loop.scan_service.interval}
+
+    def handle_command(self, command):
+        """Carry out one control command.
+
+        :returns: dict to answer with
+        """
+        actions = {'refresh': self.request_refresh,
+                   'online': self.go_online,
+                   'offline': self.go_offline,
+                   'stop': self.stop}
+        if command == 'status':
+            return self.status()
+        if command not in actions:
+            return {'error': "Unknown command '%s'" % command}
+        actions[command]()
+        return {'ok': True}
+
+    def install_signal_handlers(self):
+        """Control the daemon with SIGTERM, SIGINT, SIGHUP and SIGUSR1.
+        Must be called from the main thread.
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: Settings.read_prefs_from_file())
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: self.request_refresh())
+
+    def _shut_down(self):
+        if self._control_server is not None:
+            self._control_server.close()
+            self._control_server = None
+        self.location_loop.shut_down()
+
+
+def default_control_path():
+    """The control socket in the preferences directory. :meth:`Settings.init`
+    must have been called first.
+    """
+    return os.path.join(Settings.DATA_DIR, 'daemon.sock')
+
+
+def send_command(command, control_path=None):
+    """Send `command` to a running daemon.
+
+    :returns: The answer, as a dict
+    """
+    return unixsocket.send_line(control_path or default_control_path(),
+                                command)
+
+
+def main():
+    Settings.init()
+    locator.select_scan_backend()
+    sync.open_cache()
+
+    try:
+        Settings.USER_NAME
+    except Undefined_Value_Error:
+        Settings.USER_NAME = getuser()
+
+    if not Settings.IS_AUTHENTICATED:
+        print "Not signed in; open the address below in a browser to sign in"
+        import authserver
+        if not authserver.authenticate():
+            print "Timed out waiting for the user to sign in"
+    client_api.register_user(Settings.USER_NAME)
+
+    control_path = None
+    if hasattr(socket, 'AF_UNIX'):
+        control_path = default_control_path()
+    try:
+        daemon = LocationDaemon(control_path)
+        daemon.install_signal_handlers()
+        daemon.run()
+    except (outbox.Outbox_In_Use_Error,
+            unixsocket.Socket_In_Use_Error) as e:
+        print "Another client of this user is running already"
+        print e
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'send':
+        # python headless.py send COMMAND
+        Settings.init()
+        print json.dumps(send_command(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,298 @@
+"""The location pipeline: scan the nearby access points, find the nearest
+bind, tell the server where the user is and look up the place.
+
+Given a running :class:`signal_strength.ScanService`, a :class:`Locator`
+uses the scans that service already made. Without one, it scans on the
+spot; the first time it runs it answers after a single scan and lets the
+remaining samples finish in the background, so the user sees a location
+as soon as possible after startup.
+
+A :class:`Locator` keeps its state between refreshes, which lets it skip
+the upload when the user has not moved: a position is only queued when
+the nearest bind differs from the last one uploaded, or when
+:attr:`Settings.HEARTBEAT_FREQ` seconds have passed since then, so the
+server still knows the user is online.
+
+Only finding the nearest bind and looking up its place hold up
+:meth:`Locator.locate`. The places don't depend on the signals, so on a
+cold cache they are downloaded alongside the scan and the binds, and a
+position is handed to the outbox, which uploads it in the background
+while the place is looked up.
+
+.. code-block:: python
+
+    import locator, outbox
+    positions = outbox.PositionOutbox()
+    positions.start()
+    my_locator = locator.Locator(positions, username='jceipek')
+    print my_locator.locate()
+
+The tray application (:mod:`mapclient`) and the daemon (:mod:`headless`)
+both keep the location up to date with a :class:`LocationLoop`, which
+scans in the background and refreshes the location when an
+:class:`scheduler.AdaptiveScheduler` says so.
+
+"""
+
+import os
+import time
+from getpass import getuser
+
+import async_api
+import client_api
+import fingerprints
+import outbox
+import scheduler
+import signal_strength
+import sync
+from configuration import Settings
+
+
+def select_scan_backend():
+    """Set up :mod:`signal_strength` to scan with the backend named by
+    :attr:`Settings.SCAN_BACKEND`. With ``auto``, scans are taken from the
+    :mod:`scanhost` of this machine if one is running and its socket can
+    be trusted (see :func:`signal_strength.check_shared_scanner`).
+    """
+    name = Settings.SCAN_BACKEND
+    shared_path = (Settings.SCAN_SHARED_PATH or
+                   signal_strength.default_shared_scanner_path())
+    if name == 'auto' and os.path.exists(shared_path):
+        try:
+            signal_strength.check_shared_scanner(shared_path)
+            name = 'shared'
+        except (OSError, ValueError) as e:
+            print "Not using the shared scanner at %s: %s" % (shared_path, e)
+    if name == 'replay':
+        return signal_strength.select_backend(
+            'replay', path=Settings.SCAN_REPLAY_PATH,
+            interval=Settings.SCAN_REPLAY_INTERVAL)
+    if name == 'shared':
+        return signal_strength.select_backend('shared', path=shared_path)
+    return signal_strength.select_backend(name)
+
+
+class Locator(object):
+    """Turns signal readings into a place, uploading positions as needed.
+
+    :param position_outbox: Where positions to upload are queued
+    :type position_outbox: :class:`outbox.PositionOutbox`
+    :param username: Whose position to upload; defaults to the
+        current system user
+    :type username: str
+    :param scan_service: Where to get recent scans from, instead of
+        scanning on every refresh
+    :type scan_service: :class:`signal_strength.ScanService`
+    """
+
+    def __init__(self, position_outbox, username=None, scan_service=None):
+        self.position_outbox = position_outbox
+        self.username = username or getuser()
+        self.scan_service = scan_service
+        self.index = fingerprints.FingerprintIndex()
+        self._index_version = None
+        self.last_uploaded_bind = None
+        self.last_upload_time = None
+
+    def nearest_bind(self, signals):
+        """The bind closest to `signals`, or None if there are no binds.
+
+        Binds come from :data:`sync.binds`, which is only revalidated with
+        the server once it is older than :attr:`Settings.CACHE_TTL`.
+        """
+        sync.binds.revalidate(Settings.CACHE_TTL)
+        if self._index_version != sync.binds.version:
+            self._index_version = sync.binds.version
+            self.index.rebuild(sync.binds.values())
+        nearest_binds = self.index.nearest(signals, limit=1)
+        if nearest_binds:
+            return nearest_binds[0]
+        return None
+
+    def place_of(self, bind):
+        """The :class:`client_api.Place` that `bind` belongs to"""
+        sync.places.revalidate(Settings.CACHE_TTL)
+        place = sync.places.get(bind.place)
+        if place is None:
+            place = client_api.get_place(bind.place)
+        return place
+
+    def should_upload(self, bind):
+        """True if the server needs to hear that the user is at `bind`:
+        either the user moved, or the heartbeat interval has passed.
+        """
+        if self.last_uploaded_bind is None:
+            return True
+        if bind.id != self.last_uploaded_bind.id:
+            return True
+        return time.time() - self.last_upload_time >= Settings.HEARTBEAT_FREQ
+
+    def upload(self, bind):
+        """Queue a position at `bind`, unless the server already knows.
+        If the user moved, the outbox uploads it right away, without
+        waiting for the upload to finish.
+        """
+        if not self.should_upload(bind):
+            return False
+        moved = (self.last_uploaded_bind is None or
+                 bind.id != self.last_uploaded_bind.id)
+        self.position_outbox.add(
+            client_api.Position(username=self.username, bind=bind),
+            urgent=moved)
+        self.last_uploaded_bind = bind
+        self.last_upload_time = time.time()
+        return True
+
+    def locate(self, signals=None):
+        """Run the whole pipeline once.
+
+        :param signals: dict of the form {MAC_AddressSTR : signal_strengthINT };
+            if not given, the latest scans of the scan service are
+            averaged, or a fresh set of samples is taken with a
+            :class:`signal_strength.Scanner`
+        :type signals: dict
+
+        :returns: The :class:`client_api.Place` the user is at, or None if
+            there are no signals or no binds to compare them against
+        """
+        places_download = self._prefetch_places()
+        if signals is None and self.scan_service is not None:
+            signals = self.scan_service.signals_dict()
+        elif signals is None:
+            scanner = signal_strength.Scanner().start()
+            if self.last_uploaded_bind is None:
+                # Nothing is known yet; a single scan beats waiting
+                scanner.wait(samples=1)
+            else:
+                scanner.wait()
+            signals = scanner.signals_dict()
+        if not signals:
+            # i.e. the scan service was stopped before its first scan
+            return None
+        bind = self.nearest_bind(signals)
+        if bind is None:
+            return None
+        self.upload(bind)
+        if places_download is not None:
+            places_download.wait()
+        return self.place_of(bind)
+
+    def _prefetch_places(self):
+        """Start downloading the places in the background if there are
+        none yet, so that the download overlaps with scanning and with
+        fetching the binds.
+
+        :returns: :class:`async_api.Future`, or None if the places are
+            already there
+        """
+        if len(sync.places):
+            return None
+        return async_api.submit(_revalidate_places)
+
+
+class LocationLoop(object):
+    """Everything that keeps the location up to date, without deciding
+    which thread does what: the front end calls :meth:`check` every
+    :attr:`next_interval` seconds, and starts a refresh (i.e. calls
+    :meth:`start_refresh`, then :meth:`Locator.locate`) whenever it says
+    so.
+
+    :param username: Whose position to upload; defaults to the
+        current system user
+    :type username: str
+    :param outbox_path: Where to keep the positions waiting for upload;
+        see :class:`outbox.PositionOutbox`
+    :type outbox_path: str
+    :raises outbox.Outbox_In_Use_Error: if another process uses the file
+        at `outbox_path`
+    """
+
+    def __init__(self, username=None, outbox_path=None):
+        self.position_outbox = outbox.PositionOutbox(path=outbox_path)
+        self.scan_service = signal_strength.ScanService(
+            interval=Settings.SCAN_INTERVAL)
+        # Remembers what was uploaded last, so it has to outlive refreshes
+        self.locator = Locator(self.position_outbox, username=username,
+                               scan_service=self.scan_service)
+        self.scheduler = scheduler.AdaptiveScheduler(
+            min_interval=Settings.SCAN_INTERVAL,
+            max_refresh_interval=Settings.REFRESH_FREQ,
+            threshold=Settings.DRIFT_THRESHOLD)
+        self.refresh_requested = False
+
+    @property
+    def next_interval(self):
+        """Seconds until the next :meth:`check`"""
+        return self.scheduler.next_interval
+
+    def start(self):
+        """Start scanning and uploading in the background."""
+        self.position_outbox.start()
+        self.scan_service.start()
+
+    def request_refresh(self):
+        """Have the next :meth:`check` ask for a refresh."""
+        self.refresh_requested = True
+
+    def check(self, timeout=0):
+        """Decide whether to refresh the location now, and slow the
+        scans down while the user stays put.
+
+        :param timeout: Seconds to wait for the first scan, if there is
+            none yet
+        :type timeout: float
+        :returns: True if a refresh was requested or the user seems to
+            have moved. Until :meth:`start_refresh` is called, every check
+            keeps asking for it.
+        """
+        self.scheduler.max_refresh_interval = Settings.REFRESH_FREQ
+        due = False
+        if self.scan_service.wait_for_scan(timeout=timeout):
+            due = (self.refresh_requested or
+                   self.scheduler.check(self._newest_scan()))
+        # No point in scanning more often than we check
+        self.scan_service.interval = self.scheduler.next_interval
+        return due
+
+    def start_refresh(self):
+        """Record that a refresh starts now. Later checks compare the scans
+        with the newest one at this moment.
+        """
+        self.refresh_requested = False
+        self.scheduler.mark_refreshed(self._newest_scan() or None)
+
+    def refresh(self):
+        """Refresh the location on the calling thread.
+
+        :returns: See :meth:`Locator.locate`
+        """
+        self.start_refresh()
+        # The locator averages the latest scans itself
+        return self.locator.locate()
+
+    def shut_down(self, timeout=5):
+        """Stop scanning, upload whatever is waiting and save the settings.
+
+        :param timeout: Stop waiting for the upload after this many
+            seconds; positions that were not uploaded stay in the outbox
+            file
+        :type timeout: float
+        """
+        self.scan_service.stop(timeout=0)
+        self.position_outbox.stop(flush=True, timeout=timeout)
+        self.position_outbox.close()
+        Settings.flush()
+
+    def _newest_scan(self):
+        # Only the newest scan: averaging it with older ones (and their
+        # outlier rejection) would hide the first scan in a new room
+        return self.scan_service.signals_dict(samples=1, timeout=0)
+
+
+def _revalidate_places():
+    try:
+        sync.places.revalidate(Settings.CACHE_TTL)
+    except Exception as e:
+        # place_of tries again on the refresh thread
+        print "Failed to download places"
+        print e
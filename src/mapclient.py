@@ -18,6 +18,7 @@ to a preferences window
 
 """
 
+import startup  # First, so that the time spent on imports is measured
 from PySide import QtCore
 from PySide import QtGui
 from getpass import getuser
@@ -26,10 +27,9 @@ import urllib
 import os
 import sys
 
-import client_api
 from configuration import Settings, Undefined_Value_Error
-import signal_strength
-import authserver
+# The rest of the client (scanning, the cache, the HTTP stack) is imported
+# once the tray icon is up; see PreferencesWindow.start_location_loop
 
 DATA_PATH = None
 if os.getenv('DEBUG_OLIN_MM') != "TRUE":
@@ -232,16 +232,16 @@ class GetLocationThread(QtCore.QThread):
 
     location_updated_signal = QtCore.Signal(list)
 
+    def __init__(self, locator, signals=None, parent=None):
+        super(GetLocationThread, self).__init__(parent)
+        self.locator = locator
+        self.signals = signals
+
     def run(self):
         print "Getting location"
 
-        signals = signal_strength.get_avg_signals_dict()
-        nearest_binds = client_api.get_binds(nearest=signals, limit=1)
-
-        if len(nearest_binds) > 0:
-            likeliest_bind = nearest_binds[0]
-            client_api.Position(username=getuser(), bind=likeliest_bind).post()
-            likeliest_place = client_api.get_place(likeliest_bind.place)
+        likeliest_place = self.locator.locate(self.signals)
+        if likeliest_place is not None:
             self.location_updated_signal.emit([likeliest_place])
         else:
             print "No nearest binds found"
@@ -262,8 +262,19 @@ class NewLocationThread(QtCore.QThread):
 
         """
 
+    def __init__(self, scan_service, parent=None):
+        super(NewLocationThread, self).__init__(parent)
+        self.scan_service = scan_service
+
     def run(self):
-        signals = signal_strength.get_avg_signals_dict()
+        # The scan service has usually scanned recently, so this is instant.
+        # Older scans may be from the room the user just left.
+        signals = self.scan_service.signals_dict(
+            max_age=2 * Settings.SCAN_INTERVAL, timeout=0)
+        if not signals:
+            # Scanning slows down while the user stays put
+            import signal_strength
+            signals = signal_strength.get_avg_signals_dict()
 
         upload_dict = dict()
         for key, value in signals.iteritems():
@@ -275,6 +286,52 @@ class NewLocationThread(QtCore.QThread):
                          urllib.urlencode(upload_dict))
                         )
 
+class StartupThread(QtCore.QThread):
+    """The startup work that needs the disk or the network: opening the
+        cache of binds and places, signing in and registering the user with
+        the server.
+
+        It runs once the tray icon is up, so that a slow server doesn't keep
+        the application from appearing. The first location refresh starts
+        when it finishes.
+
+        """
+
+    def __init__(self, parent=None):
+        import authserver
+
+        super(StartupThread, self).__init__(parent)
+        self.cancelled = False
+        self.auth_server = authserver.AuthCallbackServer()
+
+    def run(self):
+        import authserver
+        import client_api
+        import sync
+
+        sync.open_cache()
+        startup.timer.mark('cache opened')
+
+        if not Settings.IS_AUTHENTICATED and not self.cancelled:
+            if authserver.authenticate(server=self.auth_server):
+                startup.timer.mark('authenticated')
+            elif not self.cancelled:
+                print "Timed out waiting for the user to sign in"
+
+        if self.cancelled:
+            return
+        client_api.register_user(Settings.USER_NAME)
+        startup.timer.mark('user registered')
+
+    def cancel(self):
+        '''
+            Stop waiting for the user to sign in and skip the rest of the
+            startup, so that the thread finishes right away. Called from
+            the GUI thread when the application quits.
+            '''
+        self.cancelled = True
+        self.auth_server.stop()
+
 class PreferencesWindow(QtGui.QDialog):
     """The preferences window is the owner of everything else in the program.
         It should not be instantiated more than once.
@@ -311,13 +368,68 @@ class PreferencesWindow(QtGui.QDialog):
 
         self.is_online = True
 
+        self.is_quitting = False
+
+        self.startup_thread = None
         self.refresh_thread = None
         self.creation_thread = None
+        self.creation_pending = False
+
+        self.location_loop = None
+        QtCore.QTimer.singleShot(0, self.start_location_loop)
 
-        # Refresh location the first time. Thereafter, the location will be
-        # refreshed after an interval specified in the Settings
+    def start_location_loop(self):
+        '''
+            Starts scanning and uploading in the background, then the
+            startup thread. Called once the event loop runs, so that the
+            imports it needs don't keep the tray icon from appearing.
+            '''
+        import locator
+        import metrics
+        import outbox
+
+        locator.select_scan_backend()
+        try:
+            # Outlives the threads, since its locator remembers what was
+            # uploaded last
+            self.location_loop = locator.LocationLoop(
+                outbox_path=os.path.join(Settings.DATA_DIR, 'outbox.jsonl'))
+        except outbox.Outbox_In_Use_Error as e:
+            # i.e. the daemon (headless.py) is running for this user
+            print "ERROR: Unable to launch Marauder's Map!"
+            print e
+            self.sys_tray.hide()
+            QtGui.qApp.exit(1)
+            return
+        self.location_loop.start()
+        startup.timer.mark('location loop started')
+
+        if Settings.METRICS_DUMP_FREQ > 0:
+            metrics.request_metrics.start_dumping(
+                os.path.join(Settings.DATA_DIR, 'metrics.json'),
+                Settings.METRICS_DUMP_FREQ)
+
+        # Refresh location the first time once the startup thread is done.
+        # Thereafter, the location will be refreshed when the signal
+        # strengths change, or after an interval specified in the Settings
         # (if the user is online)
+        self.startup_thread = StartupThread()
+        self.startup_thread.finished.connect(self.startup_finished)
+        self.startup_thread.start()
+
+    @QtCore.Slot()
+    def startup_finished(self):
+        '''
+            Called (through the thread's `finished` signal) once the user
+            is signed in and registered.
+            '''
+        self.startup_thread = None
+        if self.is_quitting:
+            self.quit_if_ready()
+            return
         self.refresh_location()
+        QtCore.QTimer.singleShot(self.location_loop.next_interval*1000,
+                                 self.check_location)
 
     def set_size(self, width, height):
         self.setMinimumWidth(width)
@@ -429,64 +541,79 @@ class PreferencesWindow(QtGui.QDialog):
 
         return sys_tray_menu
 
+    def check_location(self):
+        '''
+            Compares the latest background scans with those at the last
+            refresh and refreshes the location if the user seems to have
+            moved (see :class:`scheduler.AdaptiveScheduler`). Reschedules
+            itself, checking less often while the user stays put.
+            '''
+        if self.is_online and self.location_loop.check():
+            # If a refresh is running already, the next check asks again
+            self.refresh_location()
+        QtCore.QTimer.singleShot(self.location_loop.next_interval*1000,
+                                 self.check_location)
+
     def refresh_location(self):
         '''
-            Creates a thread to refresh the location.
+            Creates a thread to refresh the location, unless one is
+            already running. The locator averages the latest scans itself.
             '''
 
         #self.sys_tray.showMessage("Updating", "Determining Location...")
 
-        should_create_new_thread = False
+        if self.refresh_thread or not self.is_online:
+            # The location is being refreshed already
+            return
 
-        if self.refresh_thread:
-            # Thread exists
-            if self.refresh_thread.isFinished():
-                print "Thread Finished"
-                del self.refresh_thread
-                self.refresh_thread = None
-                should_create_new_thread = True
-        else:
-            should_create_new_thread = True
-
-        if should_create_new_thread and self.is_online:
-            self.refresh_thread = GetLocationThread()
-            self.refresh_thread.location_updated_signal.connect(self.location_slot)
-            self.refresh_thread.start()
-            # TODO: Match freq to settings
-            print Settings.REFRESH_FREQ*1000
-            QtCore.QTimer.singleShot(Settings.REFRESH_FREQ*1000, self.refresh_location)
-        else:
-            # Only wait a bit before rechecking
-            # if the thread is still running
-            QtCore.QTimer.singleShot(200, self.refresh_location)
+        self.location_loop.start_refresh()
+        self.refresh_thread = GetLocationThread(self.location_loop.locator)
+        self.refresh_thread.location_updated_signal.connect(self.location_slot)
+        self.refresh_thread.finished.connect(self.refresh_finished)
+        self.refresh_thread.start()
 
+    @QtCore.Slot()
+    def refresh_finished(self):
+        '''
+            Called (through the thread's `finished` signal) when a location
+            refresh is done.
+            '''
+        print "Thread Finished"
+        self.refresh_thread = None
+        self.quit_if_ready()
 
     def new_location(self):
         '''
-            Creates a thread to allow new bind creation.
+            Creates a thread to allow new bind creation. If one is still
+            running, a new one is started as soon as it finishes.
             '''
 
-        should_create_new_thread = False
         if self.creation_thread:
-            if self.creation_thread.isFinished():
-                print "Thread Finished"
-                del self.creation_thread
-                self.creation_thread = None
-                should_create_new_thread = True
-            else:
-                # Only wait a bit before rechecking
-                # if the thread is still running
-                QtCore.QTimer.singleShot(200, self.new_location)
-        else:
-            should_create_new_thread = True
+            self.creation_pending = True
+            return
 
-        if should_create_new_thread:
-            self.sys_tray.showMessage("Gathering Data...",
-                                      "Set your location once a browser is launched.")
-            self.creation_thread = NewLocationThread()
-            self.creation_thread.start()
+        self.creation_pending = False
+        self.sys_tray.showMessage("Gathering Data...",
+                                  "Set your location once a browser is launched.")
+        self.creation_thread = NewLocationThread(
+            self.location_loop.scan_service)
+        self.creation_thread.finished.connect(self.creation_finished)
+        self.creation_thread.start()
 
-            self.location_indicator.setText("Location: Being Set")
+        self.location_indicator.setText("Location: Being Set")
+
+    @QtCore.Slot()
+    def creation_finished(self):
+        '''
+            Called (through the thread's `finished` signal) when the bind
+            creation view was opened.
+            '''
+        print "Thread Finished"
+        self.creation_thread = None
+        if self.is_quitting:
+            self.quit_if_ready()
+        elif self.creation_pending:
+            self.new_location()
 
     def display(self):
         '''
@@ -536,29 +663,38 @@ class PreferencesWindow(QtGui.QDialog):
     def sys_tray_quit_action(self):
         '''
             Cleans up and quits the application.
-            '''
 
-        #self.offline_signal.emit()
-        #self.bg_thread.quit()
-        #while not self.bg_thread.isFinished():
-        #continue # Wait until thread done
+            Background threads are not waited for here: the application
+            quits from :meth:`quit_if_ready` once the last one emits its
+            `finished` signal, which happens right away if none are running.
+            '''
 
         # On Ubuntu 10.10 (at least), a Python fatal error is encountered if
         # the window is not hidden before the application exits
+        self.hide()
 
         self.is_online = False
-        if self.refresh_thread:
+        self.is_quitting = True
+        # Unblocks a refresh that is still waiting for its first scan
+        self.location_loop.scan_service.stop(timeout=0)
+        if self.startup_thread:
+            # Otherwise it waits up to AUTH_TIMEOUT for the user to sign in
+            self.startup_thread.cancel()
+
+        if self.startup_thread or self.refresh_thread or self.creation_thread:
             self.sys_tray.showMessage("Cleaning Up...",
                                       "Closing background threads; please wait.")
-            while self.refresh_thread.isRunning():
-                pass
-        if self.creation_thread:
-            self.sys_tray.showMessage("Cleaning Up...",
-                                      "Closing background threads; please wait.")
-            while self.creation_thread.isRunning():
-                pass
+        self.quit_if_ready()
 
-        self.hide()
+    def quit_if_ready(self):
+        '''
+            Quits once quitting was requested and no background thread
+            is running anymore.
+            '''
+        if (not self.is_quitting or self.startup_thread or
+                self.refresh_thread or self.creation_thread):
+            return
+        self.location_loop.shut_down()
         QtGui.qApp.quit()
 
     def sys_tray_initiate_location_refresh(self):
@@ -566,7 +702,7 @@ class PreferencesWindow(QtGui.QDialog):
 
     def sys_tray_go_offline(self):
         if self.is_online:
-            if self.refresh_thread.isRunning():
+            if self.refresh_thread:
                 self.sys_tray.showMessage("Finishing Up",
                                           "Going offline once this operation is complete...")
             self.offline_action.setText("Go Online")
@@ -584,6 +720,8 @@ class PreferencesWindow(QtGui.QDialog):
         if len(locations) > 0:
             print "I'm at %s" % locations[0]
             self.location_indicator.setText("Location: %s" % locations[0].alias)
+            startup.timer.mark('first location shown')
+            startup.timer.finish()
         else:
             print "No locations found"
 
@@ -615,10 +753,11 @@ def can_launch():
 if __name__ == '__main__':
     import sys
 
-    Settings.init()
+    # python mapclient.py --startup-timing prints how long startup took
+    startup.timer.enabled = '--startup-timing' in sys.argv
+    startup.timer.mark('imports')
 
-    if not Settings.IS_AUTHENTICATED:
-        authserver.authenticate()
+    Settings.init()
 
     is_first_launch = False
 
@@ -630,23 +769,7 @@ if __name__ == '__main__':
         username = getuser()
         Settings.USER_NAME = username
         is_first_launch = True
-
-    try:
-        # Register username if it doesn't exist on the server
-        username = getuser()
-
-        client_api.get_user(username)
-
-    except client_api.Unable_To_Connect_Error:
-        print "Unable to connect to marauder's map server"
-    except KeyError:
-        print "User not found on server. Posting."
-        print "Making User"
-        user = client_api.User(username=Settings.USER_NAME,
-                               alias="Unknown")
-        user.put()
-
-
+    startup.timer.mark('settings')
 
     app = QtGui.QApplication(sys.argv)
     able_to_launch, reason = can_launch()
@@ -658,6 +781,7 @@ if __name__ == '__main__':
     else:
         # Note: we have to retain a reference to the window so that it isn't killed
         preferences_window = setup_window()
+        startup.timer.mark('tray icon shown')
         if is_first_launch:
             preferences_window.display()
         sys.exit(app.exec_())
@@ -0,0 +1,124 @@
+"""A small, thread-safe LRU cache with optional expiry, used by
+:mod:`client_api` to avoid fetching the same place, bind or user over and
+over again.
+
+.. code-block:: python
+
+    from memo import LRUCache, memoize
+
+    _cache = LRUCache(maxsize=64, ttl=60)
+
+    @memoize(_cache)
+    def slow_lookup(identifier):
+        ...
+
+    slow_lookup(3)             # Miss: calls slow_lookup
+    slow_lookup(3)             # Hit: answered from _cache
+    slow_lookup.invalidate(3)  # The next call fetches again
+    print _cache.stats()
+
+"""
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A mapping that holds at most `maxsize` entries, dropping the least
+    recently used one when it is full.
+
+    :param maxsize: Maximum number of entries
+    :type maxsize: int
+    :param ttl: Seconds after which an entry expires, or None to keep
+        entries until they are evicted or invalidated
+    :type ttl: float
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, time stored)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Look up `key`, marking it as recently used.
+
+        :returns: tuple of (found, value)
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                value, stored_at = entry
+                if self.ttl is None or time.time() - stored_at < self.ttl:
+                    self._entries[key] = entry  # Move to the end
+                    self.hits += 1
+                    return True, value
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Forget `key`, or everything if no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """:returns: dict with the keys ``hits``, ``misses``, ``size``
+            and ``maxsize``
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries),
+                    'maxsize': self.maxsize}
+
+
+def memoize(cache):
+    """Decorator that stores the results of a one-argument function in
+    `cache`, keyed by that argument.
+
+    The argument is only used in urls, so ``3`` and ``'3'`` share an
+    entry. The decorated function gets an ``invalidate(key=None)``
+    attribute that understands the same keys.
+
+    :type cache: :class:`LRUCache`
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(key):
+            found, value = cache.get(_normalize(key))
+            if not found:
+                value = func(key)
+                cache.put(_normalize(key), value)
+            return value
+
+        def invalidate(key=None):
+            if key is None:
+                cache.invalidate()
+            else:
+                cache.invalidate(_normalize(key))
+
+        wrapper.cache = cache
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
+
+
+def _normalize(key):
+    return u'%s' % key
@@ -0,0 +1,242 @@
+"""Per-endpoint request statistics for :mod:`client_api`.
+
+Every request the :class:`transport.Transport` sends is recorded in
+:data:`request_metrics`, grouped by endpoint, i.e. ``GET /places/{id}``
+rather than every distinct url. For each endpoint it keeps the number of
+requests, how many failed without an answer, the status codes returned,
+the bytes sent and received and a histogram of the latencies.
+
+.. code-block:: python
+
+    import metrics
+    print metrics.request_metrics.snapshot()['GET /binds/']['latency']
+    metrics.request_metrics.add_hook(lambda record: log(record))
+    metrics.request_metrics.start_dumping('/tmp/metrics.json', interval=60)
+
+"""
+
+import json
+import threading
+import time
+import urlparse
+
+from atomicfile import atomic_write
+
+
+# Upper bounds of the latency buckets, in milliseconds; the last bucket
+# holds everything slower
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram(object):
+    """Counts values in fixed buckets.
+
+    :param bounds: Increasing upper bounds of the buckets. Values above the
+        last bound go in an extra, unbounded bucket.
+    :type bounds: tuple
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        bucket = 0
+        while bucket < len(self.bounds) and value > self.bounds[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def percentile(self, percent):
+        """An upper bound for the `percent` percentile, i.e. the bound of
+        the bucket it falls in (or the maximum, for the last bucket).
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                if bucket < len(self.bounds):
+                    return min(self.bounds[bucket], self.maximum)
+                return self.maximum
+        return self.maximum
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.minimum,
+                'max': self.maximum,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': dict(zip([str(bound) for bound in self.bounds] +
+                                    ['inf'], self.counts))}
+
+
+class _EndpointStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.status_codes = dict()
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {'requests': self.requests,
+                'errors': self.errors,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'status_codes': dict((str(code), count) for code, count
+                                     in self.status_codes.iteritems()),
+                'latency': self.latency.as_dict()}
+
+
+class RequestMetrics(object):
+    """Thread-safe request statistics, grouped by endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = dict()
+        self._hooks = list()
+        self._started_at = time.time()
+        self._dump_thread = None
+        self._dump_stop = threading.Event()
+
+    def record(self, method, url, status_code=None, elapsed=0.0,
+               bytes_sent=0, bytes_received=0):
+        """Record one request.
+
+        :param status_code: The status the server answered with, or None
+            if the request failed without an answer
+        :param elapsed: Seconds from sending the request to receiving the
+            whole response
+        :type elapsed: float
+        """
+        endpoint = endpoint_of(method, url)
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = _EndpointStats()
+            stats.requests += 1
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.latency.add(elapsed * 1000.0)
+            if status_code is None:
+                stats.errors += 1
+            else:
+                stats.status_codes[status_code] = (
+                    stats.status_codes.get(status_code, 0) + 1)
+            hooks = list(self._hooks)
+
+        if hooks:
+            record = {'endpoint': endpoint, 'url': url,
+                      'status_code': status_code, 'elapsed': elapsed,
+                      'bytes_sent': bytes_sent,
+                      'bytes_received': bytes_received}
+            for hook in hooks:
+                try:
+                    hook(record)
+                except Exception as e:
+                    print "Exception in a request metrics hook"
+                    print e
+
+    def add_hook(self, hook):
+        """Call `hook` with a dict describing every request from now on,
+        with the same keys as the arguments of :meth:`record` plus
+        ``endpoint``. Hooks run on the thread that sent the request.
+        """
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def snapshot(self):
+        """:returns: dict of the form {endpointSTR : stats dict}, where
+            each stats dict has the keys ``requests``, ``errors``,
+            ``bytes_sent``, ``bytes_received``,
+            ``status_codes`` and ``latency`` (in milliseconds)
+        """
+        with self._lock:
+            return dict((endpoint, stats.as_dict()) for endpoint, stats
+                        in self._endpoints.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self._started_at = time.time()
+
+    def dump(self, path):
+        """Write a :meth:`snapshot` to `path` as JSON. The file is replaced
+        in one step, so a reader never sees half of it.
+        """
+        with self._lock:
+            started_at = self._started_at
+        report = {'since': started_at, 'written_at': time.time(),
+                  'endpoints': self.snapshot()}
+        with atomic_write(path) as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+
+    def start_dumping(self, path, interval=300):
+        """:meth:`dump` to `path` every `interval` seconds on a background
+        thread, until :meth:`stop_dumping` is called.
+        """
+        if self._dump_thread is not None:
+            return
+        self._dump_stop.clear()
+        self._dump_thread = threading.Thread(target=self._dump_periodically,
+                                             args=(path, interval))
+        self._dump_thread.daemon = True
+        self._dump_thread.start()
+
+    def stop_dumping(self):
+        if self._dump_thread is None:
+            return
+        self._dump_stop.set()
+        self._dump_thread.join()
+        self._dump_thread = None
+
+    def _dump_periodically(self, path, interval):
+        while not self._dump_stop.wait(interval):
+            try:
+                self.dump(path)
+            except Exception as e:
+                print "Failed to write request metrics"
+                print e
+
+
+def endpoint_of(method, url):
+    """Group `url` with the other urls of the same endpoint, by dropping
+    the server address and query string and replacing the record in
+    paths like ``/places/3`` with ``{id}``.
+
+    :returns: str like ``GET /places/{id}``
+    """
+    path = urlparse.urlsplit(url).path
+    segments = path.split('/')
+    for i in range(1, len(segments)):
+        collection = segments[i - 1]
+        if (collection in ('users', 'places', 'binds', 'positions') and
+                segments[i] not in ('', 'batch')):
+            segments[i] = '{id}'
+    path = '/'.join(segments)
+    api_start = path.find('/api/')
+    if api_start >= 0:
+        path = path[api_start + len('/api'):]
+    return '%s %s' % (method.upper(), path)
+
+
+request_metrics = RequestMetrics()
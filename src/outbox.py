@@ -0,0 +1,223 @@
+"""A queue of positions waiting to be uploaded to the server.
+
+Rather than sending one request per location fix from the refresh thread,
+positions are added to a :class:`PositionOutbox` and uploaded in batches
+(see :func:`client_api.post_positions`) by a background thread, either
+every `flush_interval` seconds or as soon as `batch_size` positions are
+waiting. A position whose bind is the same as the one queued right before
+it carries no new information, so it is dropped. While the server can't be
+reached, at most `max_size` positions are kept; the oldest are dropped
+first.
+
+Only one process may use an outbox file at a time; otherwise the tray
+application and a daemon of the same user would overwrite each other's
+positions. Where :mod:`fcntl` is missing (i.e. on Windows), the file is
+not locked.
+
+.. code-block:: python
+
+    import outbox
+    positions = outbox.PositionOutbox(path='/tmp/outbox.jsonl')
+    positions.start()
+    positions.add(client_api.Position(username='jceipek', bind=bind))
+    ...
+    positions.stop()  # Uploads whatever is still waiting
+    positions.close()
+
+"""
+
+import errno
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import client_api
+
+
+class Outbox_In_Use_Error(Exception):
+    """Another process is using the outbox file already."""
+    pass
+
+
+class PositionOutbox(object):
+    """Collects positions and uploads them in batches.
+
+    :param flush_interval: Seconds between uploads
+    :type flush_interval: float
+    :param batch_size: Upload right away once this many positions are
+        waiting
+    :type batch_size: int
+    :param path: If given, waiting positions are also kept in this file
+        (one JSON object per line) so that they survive a restart or a
+        failed upload
+    :type path: str
+    :param max_size: Most positions to keep waiting; once there are more,
+        the oldest are dropped
+    :type max_size: int
+    :raises Outbox_In_Use_Error: if another outbox uses the file at `path`
+        until it is closed (see :meth:`close`)
+    """
+
+    def __init__(self, flush_interval=30, batch_size=20, path=None,
+                 max_size=1000):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._flush_on_stop = True
+        self._thread = None
+        self._pending = list()
+        self._lock_file = None
+        if path is not None:
+            self._lock_file = _lock_exclusively(path + '.lock')
+            self._pending = self._read_file()[-max_size:]
+
+    def add(self, position, urgent=False):
+        """Queue `position` for upload.
+
+        :type position: :class:`client_api.Position`
+        :param urgent: Have the background thread upload right away rather
+            than at the next `flush_interval`; :meth:`add` still returns
+            without waiting for the upload
+        :type urgent: bool
+        :returns: False if the position was coalesced with the one before it
+        """
+        with self._lock:
+            if self._pending and _same_place(self._pending[-1], position):
+                return False
+            self._pending.append(position)
+            if len(self._pending) > self.max_size:
+                del self._pending[:-self.max_size]
+            self._write_file()
+            is_full = len(self._pending) >= self.batch_size
+        if is_full or urgent:
+            self._wake.set()
+        return True
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Upload everything that is waiting, on the calling thread. Failed
+        uploads stay in the outbox and are retried on the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+            if not batch:
+                return
+            try:
+                client_api.post_positions(batch)
+            finally:
+                with self._lock:
+                    # Positions get an id once the server accepts them, so
+                    # even if the upload failed part of the way through,
+                    # only the ones that weren't accepted are sent again.
+                    # Positions added during the upload stay queued.
+                    self._pending = [position for position in self._pending
+                                     if position._d.get('id') is None]
+                    self._write_file()
+
+    def start(self):
+        """Start uploading in the background."""
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, flush=True, timeout=None):
+        """Stop the background thread, uploading whatever is left first
+        if `flush` is True.
+
+        :param timeout: Stop waiting for the upload after this many
+            seconds. Positions that were not uploaded stay in the file
+            given as `path`, if any.
+        :type timeout: float
+        """
+        if self._thread is not None:
+            self._flush_on_stop = flush
+            self._stopping = True
+            self._wake.set()
+            self._thread.join(timeout)
+            self._thread = None
+        elif flush:
+            self._try_flush()
+
+    def close(self):
+        """Let other processes use the file given as `path`. Call
+        :meth:`stop` first.
+        """
+        if self._lock_file is not None:
+            # Closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stopping:
+                break
+            self._try_flush()
+        if self._flush_on_stop:
+            self._try_flush()
+
+    def _try_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print "Failed to upload positions; will retry"
+            print e
+
+    def _read_file(self):
+        if not os.path.isfile(self.path):
+            return list()
+        positions = list()
+        with open(self.path) as outbox_file:
+            for line in outbox_file:
+                line = line.strip()
+                if line:
+                    positions.append(client_api.Position(**json.loads(line)))
+        return positions
+
+    def _write_file(self):
+        if self.path is None:
+            return
+        with open(self.path, 'w') as outbox_file:
+            for position in self._pending:
+                outbox_file.write(json.dumps(position._upload_dict()))
+                outbox_file.write('\n')
+
+
+def _lock_exclusively(path):
+    """Lock `path` until the returned file is closed.
+
+    :raises Outbox_In_Use_Error: if it is locked already
+    """
+    if fcntl is None:
+        return None
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        lock_file.close()
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        raise Outbox_In_Use_Error("%s is locked by another process" % path)
+    return lock_file
+
+
+def _same_place(a, b):
+    return (a._upload_dict()['bind'] == b._upload_dict()['bind'] and
+            a.username == b.username)
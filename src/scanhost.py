@@ -0,0 +1,137 @@
+"""One scanner for every user of a machine.
+
+On terminal servers and lab machines several users run the client at the
+same time, and each of them would scan the same radio. A :class:`ScanHost`
+scans once for all of them and hands its scans out over a Unix socket;
+clients get them by using the ``shared`` scanning backend
+(:class:`signal_strength.SharedBackend`), which the client picks
+automatically when a host is running.
+
+Start the host once per machine, as root from an init script::
+
+    python scanhost.py [SOCKET_PATH]
+
+The socket is put in ``/run/maraudersmap``, which only root can write to,
+because clients only trust a socket in a directory that nobody but root
+(or themselves) can write to; otherwise any user could start a fake host
+first and make up everyone's scans. To share scans between your own
+clients only, run it as yourself with a path in a directory of your own,
+such as ``$XDG_RUNTIME_DIR``, and set :attr:`Settings.SCAN_SHARED_PATH`.
+
+It answers one command per line with a line of JSON (see
+:class:`unixsocket.LineServer`):
+
+* ``scan SINCE`` - the latest scan, once there is one taken after the
+  time SINCE: ``{"time": ..., "nodes": [[BSSID, SSID, strength], ...]}``
+
+A host that is already running keeps its socket; a second one refuses to
+start.
+
+"""
+
+import os
+import signal
+import sys
+import threading
+
+import signal_strength
+import unixsocket
+
+
+class ScanHost(object):
+    """Scans in the background and serves the scans to local clients.
+
+    :param path: Where to create the Unix socket
+    :type path: str
+    :param interval: Seconds between the start of two scans
+    :type interval: float
+    """
+
+    def __init__(self, path=None, interval=5):
+        self.path = path or signal_strength.default_shared_scanner_path()
+        self.interval = interval
+        self.scan_service = signal_strength.ScanService(interval=interval)
+        self._server = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start scanning and serving on background threads.
+
+        :raises ValueError: if other users can write to the socket's
+            directory, so clients wouldn't trust it
+        :raises unixsocket.Socket_In_Use_Error: if another host is
+            serving on the socket
+        :returns: the host itself
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            # Everyone may connect, but only this user may add files
+            os.chmod(directory, 0755)
+        signal_strength.check_shared_scanner_directory(directory)
+        # Every user on the machine may read the scans; nobody else can
+        # replace the socket, since they can't write to its directory
+        self._server = unixsocket.LineServer(self.path, self.handle_command,
+                                             timeout=120, mode=0666)
+        self.scan_service.start()
+        self._server.start()
+        return self
+
+    def wait(self):
+        """Block until :meth:`stop` is called."""
+        # A timeout keeps signal handlers responsive on Python 2
+        while not self._stopped.wait(1):
+            pass
+
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        """Stop serving, remove the socket and stop scanning."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        self.scan_service.stop(timeout=0)
+
+    def handle_command(self, line):
+        """Answer one request line.
+
+        :returns: dict to answer with
+        """
+        parts = line.split()
+        try:
+            if parts[0] == 'scan':
+                since = float(parts[1]) if len(parts) > 1 else None
+                return self._scan(since)
+        except (IndexError, ValueError):
+            pass
+        return {'error': "Can't understand '%s'" % line}
+
+    def _scan(self, since):
+        # A scan normally arrives within one interval; give up well after
+        # that and hand out the latest one, if any
+        latest = self.scan_service.latest_scan(newer_than=since,
+                                               timeout=2 * self.interval + 5)
+        if latest is None:
+            return {'error': "No scan yet"}
+        scanned_at, nodes_dict = latest
+        return {'time': scanned_at,
+                'nodes': [[node.MAC_address, node.name, node.signal_strength]
+                          for node in nodes_dict.itervalues()]}
+
+
+if __name__ == '__main__':
+    # The host does the actual scanning, so it can't use the shared backend
+    signal_strength.select_backend('auto')
+    try:
+        host = ScanHost(sys.argv[1] if len(sys.argv) > 1 else None).start()
+    except unixsocket.Socket_In_Use_Error as e:
+        print e
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, lambda signum, frame: host.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: host.stop())
+    print "Serving scans on %s" % host.path
+    try:
+        host.wait()
+    finally:
+        host.close()
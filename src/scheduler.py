@@ -0,0 +1,94 @@
+"""Decides when the location needs a full refresh.
+
+Finding the nearest bind and uploading a position is only worth doing when
+the user has moved. The :class:`AdaptiveScheduler` is asked at regular
+intervals whether the latest (cheap, background) scans differ enough from
+the ones at the last full refresh. If they do, it asks for a refresh and
+goes back to checking often; if they don't, it checks less and less often,
+down to once every `max_interval` seconds, and the scans can slow down
+with it. A refresh is requested at least every `max_refresh_interval`
+seconds regardless, so the server keeps hearing from the client.
+
+.. code-block:: python
+
+    scheduler = AdaptiveScheduler(min_interval=10)
+    while True:
+        newest_scan = scan_service.signals_dict(samples=1)
+        if scheduler.check(newest_scan):
+            scheduler.mark_refreshed(newest_scan)
+            my_locator.locate()
+        time.sleep(scheduler.next_interval)
+
+"""
+
+import time
+
+from fingerprints import fingerprint_distance
+
+
+class AdaptiveScheduler(object):
+    """Keeps track of when to check for movement and when to refresh.
+
+    :param min_interval: Seconds between checks right after a refresh
+    :type min_interval: float
+    :param max_interval: Longest time between checks while the user is
+        not moving
+    :type max_interval: float
+    :param max_refresh_interval: Longest time between two refreshes
+    :type max_refresh_interval: float
+    :param threshold: How far the scans must drift from those at the last
+        refresh (see :func:`fingerprints.fingerprint_distance`) before the
+        user is considered to have moved
+    :type threshold: float
+    :param backoff: What the interval between checks is multiplied by
+        every time the user has not moved
+    :type backoff: float
+    """
+
+    def __init__(self, min_interval=10, max_interval=120,
+                 max_refresh_interval=300, threshold=10.0, backoff=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_refresh_interval = max_refresh_interval
+        self.threshold = threshold
+        self.backoff = backoff
+        self.next_interval = min_interval
+        self.last_refresh = None
+        self.reference = None  # Signals at the last refresh
+
+    def check(self, signals):
+        """Compare `signals` with those at the last refresh.
+
+        :param signals: dict of the form {MAC_AddressSTR : signal_strengthINT }
+        :type signals: dict
+        :returns: True if the location should be refreshed now. Call
+            :meth:`mark_refreshed` once the refresh has actually started;
+            until then, every check keeps asking for it, so a move noticed
+            while a refresh can't start (i.e. another one is running) is
+            not lost.
+        """
+        now = time.time()
+        if (self.last_refresh is None or
+                now - self.last_refresh >= self.max_refresh_interval):
+            self.next_interval = self.min_interval
+            return True
+        if self.reference is None:
+            self.reference = signals
+        elif fingerprint_distance(self.reference, signals) > self.threshold:
+            self.next_interval = self.min_interval
+            return True
+        self.next_interval = min(self.next_interval * self.backoff,
+                                 max(self.max_interval, self.min_interval))
+        return False
+
+    def mark_refreshed(self, signals=None):
+        """Record that the location was just refreshed, i.e. when the user
+        asked for it, and go back to checking often.
+
+        :param signals: The signals the refresh was based on, if known
+        :type signals: dict
+        """
+        self.last_refresh = time.time()
+        self.next_interval = self.min_interval
+        if signals is not None:
+            self.reference = signals
@@ -1,7 +1,88 @@
 import os
 import sys
 import subprocess
+import collections
 import json
+import re
+import socket
+import stat
+import threading
+import time
+
+
+class _LazyModule(object):
+    """Imports the module `name` the first time one of its attributes is
+    used."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = __import__(self._name)
+        return getattr(self._module, attribute)
+
+
+# numpy takes a while to import, so it isn't imported when the client
+# starts, only once a SampleMatrix uses it
+numpy = _LazyModule('numpy')
+
+
+# BSSIDs and SSIDs are interned: every distinct BSSID is parsed once into
+# a 48-bit integer and every distinct SSID gets a small index. A SignalNode
+# then only needs one integer (the index shifted above the BSSID) to know
+# which access point it belongs to, and hashing it allocates nothing.
+#
+# Scans are dicts of the form {SignalNode.key : SignalNode}. The readings
+# are not kept in parallel arrays per scan: a scan holds a few dozen access
+# points, and once the keys stopped allocating, the dicts were no longer
+# what made scanning slow. Where many readings are processed at once they
+# go into the NumPy matrix of a SampleMatrix.
+
+_BSSID_BITS = 48
+_BSSID_MASK = (1 << _BSSID_BITS) - 1
+
+_intern_lock = threading.Lock()
+_bssid_values = dict()  # BSSID string -> 48-bit int
+_bssid_strings = dict()  # 48-bit int -> BSSID string, as first seen
+_ssid_indices = dict()  # SSID -> index
+_ssid_names = list()  # index -> SSID
+
+def parse_bssid(bssid):
+    """Convert a BSSID such as '00:20:D8:2D:2C:C1' (or '0:20:d8:2d:2c:c1')
+    into a 48-bit integer"""
+    value = 0
+    for byte in bssid.split(':'):
+        value = (value << 8) | int(byte, 16)
+    return value
+
+def format_bssid(value):
+    """Convert a 48-bit integer back into a BSSID like '00:20:D8:2D:2C:C1'"""
+    return ':'.join('%02X' % ((value >> shift) & 0xFF)
+                    for shift in range(40, -8, -8))
+
+def intern_bssid(bssid):
+    """The 48-bit integer for `bssid`, parsing it only the first time it
+    is seen"""
+    value = _bssid_values.get(bssid)
+    if value is None:
+        value = parse_bssid(bssid)
+        with _intern_lock:
+            _bssid_values[bssid] = value
+            _bssid_strings.setdefault(value, bssid)
+    return value
+
+def _intern_ssid(ssid):
+    index = _ssid_indices.get(ssid)
+    if index is None:
+        with _intern_lock:
+            index = _ssid_indices.get(ssid)
+            if index is None:
+                index = len(_ssid_names)
+                _ssid_names.append(ssid)
+                _ssid_indices[ssid] = index
+    return index
 
 class SignalNode(object):
     '''A highly optimized object to keep track of the signal strength
@@ -9,7 +90,8 @@ class SignalNode(object):
     or an element in a set.
 
     MAC_address and name are immutable once the instance is created,
-    but signal_strength can be changed
+    but signal_strength can be changed. They are stored as a single interned
+    integer (see :attr:`key`), so a node is only two slots.
 
     :param MAC_address: BSSID of the access point.
     :type MAC_address: str
@@ -19,18 +101,41 @@ class SignalNode(object):
     :type signal_strength: int
     '''
 
-    __slots__ = ('__MAC_address', '__name', 'signal_strength')
+    __slots__ = ('__key', 'signal_strength')
     def __init__(self, MAC_address, name, signal_strength):
-        self.__MAC_address = MAC_address
-        self.__name = name
+        self.__key = (_intern_ssid(name) << _BSSID_BITS) | intern_bssid(MAC_address)
         self.signal_strength = signal_strength
 
+    @classmethod
+    def from_key(cls, key, signal_strength):
+        """Create a node for an access point that was already seen, without
+        looking up its BSSID or SSID again"""
+        node = cls.__new__(cls)
+        node.__key = key
+        node.signal_strength = signal_strength
+        return node
+
+    @property
+    def key(self):
+        """Unique integer key for the access point (independent of signal_strength)
+
+        It combines the BSSID (the low 48 bits) with the interned SSID, so
+        it is only meaningful within this process; use :attr:`identifier`
+        to refer to an access point anywhere else.
+        """
+        return self.__key
+
     @property
     def identifier(self):
         """Unique string identifier for the access point (independent of signal_strength)
 
         """
-        return self.__MAC_address + self.__name
+        return self.MAC_address + self.name
+
+    @property
+    def BSSID_value(self):
+        '''BSSID of the access point, as a 48-bit integer'''
+        return self.__key & _BSSID_MASK
 
     @property
     def MAC_address(self):
@@ -38,7 +143,7 @@ class SignalNode(object):
 
         Example: '00:20:D8:2D:2C:C1'
         '''
-        return self.__MAC_address
+        return _bssid_strings[self.__key & _BSSID_MASK]
 
     @property
     def name(self):
@@ -46,16 +151,26 @@ class SignalNode(object):
 
         Example: OLIN_WH
         '''
-        return self.__name
+        return _ssid_names[self.__key >> _BSSID_BITS]
 
     def __repr__(self):
-        return "<%s,%i>" % (self.__MAC_address, self.signal_strength)
+        return "<%s,%i>" % (self.MAC_address, self.signal_strength)
 
     def __hash__(self):
-        return hash(self.__MAC_address + self.__name + str(self.signal_strength))
+        return hash(self.__key)
 
     def __eq__(self, other):
-        return self.__hash__() == other.__hash__()
+        if not isinstance(other, SignalNode):
+            return NotImplemented
+        return (self.__key == other.key and
+                self.signal_strength == other.signal_strength)
+
+    def __ne__(self, other):
+        # Python 2 doesn't derive != from ==
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
 
 
 def get_avg_signals_dict(samples=3, tsleep=0.15):
@@ -102,141 +217,850 @@ def get_avg_signal_nodes_dict(samples=3, tsleep=0.15):
         (although it will take a bit longer since getCoords() takes a while to execute)
     :type tsleep: float
 
-    :returns: dict of the form {MAC_AddressIdentifierSTR : :class:`SignalNode`\ }
+    :returns: dict of the form {keyINT : :class:`SignalNode`\ }
     """
-    import time
-    all_surrounding_nodes = dict()
+    return Scanner(samples=samples, tsleep=tsleep).start().wait().estimate()
 
-    for i in range(samples):
-        res = get_signal_node_dict()
-        for node_identifier in res:
-            if node_identifier in all_surrounding_nodes:
-                all_surrounding_nodes[node_identifier].signal_strength += res[node_identifier].signal_strength
-            else:
-                all_surrounding_nodes[node_identifier] = res[node_identifier]
-        time.sleep(tsleep)
 
+class SampleMatrix(object):
+    """Holds several scans as a (samples x access points) matrix, with
+    NaN wherever an access point was missing from a sample, so that
+    per-access-point statistics are computed for every access point at
+    once.
+
+    Outliers are rejected per access point: a reading is dropped if it is
+    more than `outlier_threshold` (scaled) median absolute deviations
+    away from that access point's median.
+
+    :param outlier_threshold: How many deviations a reading may be from
+        the median, or None to keep every reading
+    :type outlier_threshold: float
+    :param min_deviation: Smallest deviation used for the threshold, so
+        that access points with nearly identical readings don't lose
+        every reading that differs slightly
+    :type min_deviation: float
+    """
+
+    def __init__(self, outlier_threshold=3.0, min_deviation=2.0):
+        self.outlier_threshold = outlier_threshold
+        self.min_deviation = min_deviation
+        self.samples = 0
+        self._columns = dict()  # key -> column
+        self._keys = list()  # column -> key
+        self._values = numpy.empty((4, 16))
+        self._values.fill(numpy.nan)
+
+    def add(self, nodes_dict):
+        """Add one scan as a new row.
+
+        :param nodes_dict: dict of the form {key : :class:`SignalNode`\ },
+            as returned by :func:`get_signal_node_dict`
+        """
+        for key in nodes_dict:
+            if key not in self._columns:
+                self._columns[key] = len(self._keys)
+                self._keys.append(key)
+        self._reserve(self.samples + 1, len(self._keys))
+        row = self._values[self.samples]
+        for key, node in nodes_dict.iteritems():
+            row[self._columns[key]] = node.signal_strength
+        self.samples += 1
+
+    def _reserve(self, rows, columns):
+        # Grow geometrically so that adding a sample is amortized O(1)
+        old_rows, old_columns = self._values.shape
+        if rows <= old_rows and columns <= old_columns:
+            return
+        if rows > old_rows:
+            rows = max(rows, 2 * old_rows)
+        if columns > old_columns:
+            columns = max(columns, 2 * old_columns)
+        values = numpy.empty((max(rows, old_rows), max(columns, old_columns)))
+        values.fill(numpy.nan)
+        values[:old_rows, :old_columns] = self._values
+        self._values = values
+
+    def _readings(self):
+        """The readings as a masked array, with missing readings and
+        outliers masked out"""
+        readings = numpy.ma.masked_invalid(
+            self._values[:self.samples, :len(self._keys)])
+        if self.outlier_threshold is None or self.samples < 3:
+            return readings
+        median = numpy.ma.median(readings, axis=0)
+        deviation = abs(readings - median)
+        # 1.4826 makes the median absolute deviation comparable to a
+        # standard deviation for normally distributed readings
+        spread = numpy.maximum(1.4826 * numpy.ma.median(deviation, axis=0),
+                               self.min_deviation)
+        limit = (self.outlier_threshold * spread).filled(numpy.inf)
+        return numpy.ma.masked_where(deviation.filled(0) > limit, readings)
+
+    def statistics(self):
+        """Per-access-point statistics, computed in one pass.
+
+        :returns: dict of the form {key : dict} where each dict has
+            the keys ``mean``, ``median``, ``variance`` and ``count`` (the
+            number of samples used, after rejecting outliers)
+        """
+        if not self._keys or not self.samples:
+            return dict()
+        readings = self._readings()
+        counts = readings.count(axis=0)
+        means = readings.mean(axis=0).filled(numpy.nan)
+        medians = numpy.ma.median(readings, axis=0).filled(numpy.nan)
+        variances = readings.var(axis=0).filled(numpy.nan)
+        return dict(
+            (key,
+             {'mean': float(means[col]), 'median': float(medians[col]),
+              'variance': float(variances[col]), 'count': int(counts[col])})
+            for key, col in self._columns.iteritems()
+            if counts[col] > 0)
+
+    def aggregate(self, method='mean'):
+        """Combine the samples into one reading per access point.
+
+        :param method: 'mean' or 'median'
+        :type method: str
+
+        :returns: dict of the form {key : :class:`SignalNode`\ }
+        """
+        if not self._keys or not self.samples:
+            return dict()
+        readings = self._readings()
+        if method == 'median':
+            combined = numpy.ma.median(readings, axis=0)
+        elif method == 'mean':
+            combined = readings.mean(axis=0)
+        else:
+            raise ValueError("Unknown aggregation method '%s'" % method)
+        counts = readings.count(axis=0)
+        combined = combined.filled(numpy.nan)
+        result = dict()
+        for key, col in self._columns.iteritems():
+            if counts[col] > 0:
+                result[key] = SignalNode.from_key(
+                    key, float(combined[col]))
+        return result
+
+
+class Scanner(object):
+    """Takes `samples` scans on a worker thread and keeps a running average
+    of them, so the caller never blocks on a scan it doesn't need.
+
+    Each access point is averaged over the samples it actually appeared in,
+    leaving out outlying readings (see :class:`SampleMatrix`). An estimate
+    is available as soon as the first sample is in, and is refined as the
+    other samples arrive:
+
+    .. code-block:: python
+
+        scanner = Scanner(samples=3).start()
+        scanner.wait(samples=1)
+        quick_guess = scanner.estimate()
+        scanner.wait()
+        best_guess = scanner.estimate()
+
+    :param samples: Number of measurements to make & average
+    :type samples: int
+    :param tsleep: Number of seconds to wait between measurements
+    :type tsleep: float
+    :param on_sample: Called from the worker thread with the scanner after
+        every sample
+    :type on_sample: function
+    """
+
+    def __init__(self, samples=3, tsleep=0.15, on_sample=None):
+        self.samples = samples
+        self.tsleep = tsleep
+        self.on_sample = on_sample
+        self.samples_taken = 0
+        self.error = None  # Set if a scan raised an exception
+        self._condition = threading.Condition()
+        self._thread = None
+        self._finished = False
+        self._matrix = SampleMatrix()
 
-    #TODO: Figure out what to in terms of division if the else statement above is triggered.
+    def start(self):
+        """Start scanning in the background.
+
+        :returns: the scanner itself
+        """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for i in range(self.samples):
+                if i > 0:
+                    time.sleep(self.tsleep)
+                self.add_sample(get_signal_node_dict())
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def add_sample(self, nodes_dict):
+        """Merge one scan result into the running average.
+
+        :param nodes_dict: dict of the form {key : :class:`SignalNode`\ },
+            as returned by :func:`get_signal_node_dict`
+        """
+        with self._condition:
+            self._matrix.add(nodes_dict)
+            self.samples_taken += 1
+            self._condition.notify_all()
+        if self.on_sample is not None:
+            self.on_sample(self)
+
+    def wait(self, samples=None, timeout=None):
+        """Block until `samples` samples (all of them by default) are in,
+        scanning has stopped, or `timeout` seconds have passed.
+
+        If scanning stopped early because a scan failed, the exception is
+        re-raised here.
+
+        :returns: the scanner itself
+        """
+        if samples is None:
+            samples = self.samples
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            # Waiting for every sample means waiting for the worker to finish
+            while not self._finished and (samples >= self.samples or
+                                          self.samples_taken < samples):
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+        if self.error is not None and self.samples_taken < samples:
+            raise self.error
+        return self
+
+    @property
+    def finished(self):
+        """True once every sample has been taken"""
+        return self._finished
+
+    def estimate(self, method='mean'):
+        """The average of the samples taken so far.
+
+        :param method: 'mean' or 'median'
+        :type method: str
+
+        :returns: dict of the form {keyINT : :class:`SignalNode`\ }
+        """
+        with self._condition:
+            return self._matrix.aggregate(method)
 
-    # And divide each by sample count
-    for node in all_surrounding_nodes.values():
-        node.signal_strength /= float(samples)
+    def statistics(self):
+        """Per-access-point statistics of the samples taken so far; see
+        :meth:`SampleMatrix.statistics`"""
+        with self._condition:
+            return self._matrix.statistics()
+
+    def signals_dict(self):
+        """Like :meth:`estimate`, in the form returned by
+        :func:`get_avg_signals_dict`
+
+        :returns: dict of the form {MAC_AddressSTR : signal_strengthINT }
+        """
+        return dict((node.MAC_address, node.signal_strength)
+                    for node in self.estimate().itervalues())
+
+class ScanService(object):
+    """Scans continuously in the background and keeps the most recent
+    scans in a fixed-size ring buffer, so that an averaged fingerprint is
+    available instantly instead of waiting for new scans.
+
+    .. code-block:: python
+
+        service = ScanService(interval=10, capacity=6).start()
+        signals = service.signals_dict(samples=3)  # Average of the last 3 scans
+        service.stop()
+
+    :param interval: Seconds between the start of two scans
+    :type interval: float
+    :param capacity: Number of scans kept in the buffer
+    :type capacity: int
+    """
+
+    def __init__(self, interval=10, capacity=6):
+        self._interval = interval
+        self._scans = collections.deque(maxlen=capacity)  # (time, nodes_dict)
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self.error = None  # The last exception raised by a scan, if any
+
+    def start(self):
+        """Start scanning in the background.
+
+        :returns: the service itself
+        """
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop scanning, waiting up to `timeout` seconds for a scan that
+        is in progress to finish."""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    @property
+    def interval(self):
+        '''Seconds between the start of two scans. Lowering it takes effect
+        right away, rather than after the (possibly long) wait for the
+        next scan.'''
+        return self._interval
+
+    @interval.setter
+    def interval(self, value):
+        lowered = value < self._interval
+        self._interval = value
+        if lowered:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            started = time.time()
+            try:
+                self.add_scan(get_signal_node_dict())
+                self.error = None
+            except Exception as e:
+                self.error = e
+                print "Scan failed: %s" % e
+            while not self._stop_event.is_set():
+                # Recomputed on every wake, since the interval may change
+                remaining = self._interval - (time.time() - started)
+                if remaining <= 0:
+                    break
+                self._wake.wait(remaining)
+                self._wake.clear()
+
+    def add_scan(self, nodes_dict):
+        """Put a scan into the buffer, dropping the oldest one if it is full.
+
+        :param nodes_dict: dict of the form {keyINT : :class:`SignalNode`\ }
+        """
+        with self._condition:
+            self._scans.append((time.time(), nodes_dict))
+            self._condition.notify_all()
 
-    return all_surrounding_nodes
+    def wait_for_scan(self, timeout=None):
+        """Block until the buffer holds at least one scan.
+
+        :returns: True if there is a scan
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while not self._scans:
+                if deadline is None:
+                    # Wake up regularly in case the service was stopped
+                    self._condition.wait(1)
+                    if self._stop_event.is_set():
+                        break
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            return len(self._scans) > 0
+
+    def latest_scan(self, newer_than=None, timeout=None):
+        """The most recent scan, waiting up to `timeout` seconds for one
+        taken after `newer_than` if there isn't one yet.
+
+        :param newer_than: A time as returned by :func:`time.time`
+        :type newer_than: float
+
+        :returns: tuple of (time scanned, dict of the form
+            {keyINT : :class:`SignalNode`\ }), or None if there has
+            been no scan
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while newer_than is not None and (not self._scans or
+                                              self._scans[-1][0] <= newer_than):
+                remaining = 1 if deadline is None else deadline - time.time()
+                if remaining <= 0 or self._stop_event.is_set():
+                    break
+                self._condition.wait(min(remaining, 1))
+            if not self._scans:
+                return None
+            return self._scans[-1]
+
+    def recent_scans(self, samples=None, max_age=None):
+        """The most recent scans, oldest first.
+
+        :param samples: Maximum number of scans to return
+        :type samples: int
+        :param max_age: Leave out scans older than this many seconds
+        :type max_age: float
+
+        :returns: list of dicts of the form {keyINT : :class:`SignalNode`\ }
+        """
+        with self._condition:
+            scans = list(self._scans)
+        if max_age is not None:
+            oldest = time.time() - max_age
+            scans = [scan for scan in scans if scan[0] >= oldest]
+        if samples is not None:
+            scans = scans[-samples:]
+        return [nodes_dict for scanned_at, nodes_dict in scans]
+
+    def fingerprint(self, samples=3, max_age=None, method='mean', timeout=None):
+        """Aggregate the most recent scans (see :class:`SampleMatrix`),
+        waiting for the first scan if there hasn't been one yet.
+
+        :returns: dict of the form {keyINT : :class:`SignalNode`\ }
+        """
+        self.wait_for_scan(timeout)
+        matrix = SampleMatrix()
+        for nodes_dict in self.recent_scans(samples, max_age):
+            matrix.add(nodes_dict)
+        return matrix.aggregate(method)
+
+    def signals_dict(self, samples=3, max_age=None, method='mean', timeout=None):
+        """Like :meth:`fingerprint`, in the form returned by
+        :func:`get_avg_signals_dict`
+
+        :returns: dict of the form {MAC_AddressSTR : signal_strengthINT }
+        """
+        return dict((node.MAC_address, node.signal_strength)
+                    for node in self.fingerprint(samples, max_age, method,
+                                                 timeout).itervalues())
 
 def get_signal_node_dict():
     '''
     Scans (or gets cached versions, on some systems) of wireless signal strengths around the computer,
-    using platform-dependent methods.
-    Returns a dict mapping SignalNode identifiers to SignalNodes
-    '''
-
-    # WINDOWS
-    if sys.platform.startswith('win'):
-        # Should work on Windows > XP SP3
-        return __get_signal_nodes_win()
-    # LINUX
-    elif sys.platform.startswith('linux'):
-        # This should work on most recent versions of Linux, according to Riley - Julian
-        # TODO: Fall back to old method for systems without nm-tool
-        # In that case, users will need to run the application as root, however
-        return __get_signal_nodes_network_manager()
-    # MAC OS X
-    elif sys.platform.startswith('darwin'):
-        return __get_signal_nodes_mac()
-
-def __interpret_DB(signal_string):
+    using the backend chosen with :func:`select_backend` (by default, the
+    one for the current platform).
+    Returns a dict mapping SignalNode keys to SignalNodes
+    '''
+    return get_backend()()
+
+# Backends
+#
+# A backend is a callable that takes no arguments and returns a dict mapping
+# SignalNode keys to SignalNodes. Backends are registered by name
+# with a factory that creates them, so that they can be picked by name
+# (i.e. from the SCAN_BACKEND setting) or detected from sys.platform.
+
+_BACKEND_FACTORIES = dict()  # name -> (factory, platform prefixes)
+_backend = None
+
+def register_backend(name, factory, platforms=()):
+    '''
+    Make a backend available to :func:`select_backend`.
+
+    :param name: Name to select the backend by
+    :type name: str
+    :param factory: Called with the options given to :func:`select_backend`;
+        returns the backend
+    :type factory: function
+    :param platforms: Prefixes of sys.platform on which this backend is
+        picked automatically
+    :type platforms: tuple of str
+    '''
+    _BACKEND_FACTORIES[name] = (factory, tuple(platforms))
+
+def available_backends():
+    '''Names of all registered backends'''
+    return sorted(_BACKEND_FACTORIES)
+
+def select_backend(name='auto', **options):
+    '''
+    Choose how signal strengths are obtained from now on.
+
+    :param name: Name of a registered backend (see
+        :func:`available_backends`), or 'auto' to use the one for this
+        platform
+    :type name: str
+    :param options: Passed on to the backend's factory, i.e. ``path`` and
+        ``interval`` for the 'replay' backend
+
+    :returns: the backend
+    '''
+    global _backend
+    if name == 'auto':
+        name = _detect_backend_name()
+    if name not in _BACKEND_FACTORIES:
+        raise ValueError("Unknown scanning backend '%s'; choose one of %s" %
+                         (name, ', '.join(available_backends())))
+    _backend = _BACKEND_FACTORIES[name][0](**options)
+    return _backend
+
+def get_backend():
+    '''The backend in use, selecting the one for this platform if
+    :func:`select_backend` was never called'''
+    if _backend is None:
+        return select_backend()
+    return _backend
+
+def _detect_backend_name():
+    for name, (factory, platforms) in _BACKEND_FACTORIES.iteritems():
+        for platform in platforms:
+            if sys.platform.startswith(platform):
+                return name
+    raise ValueError("No scanning backend for platform '%s'" % sys.platform)
+
+class CommandBackend(object):
+    '''
+    A backend that runs a platform tool and parses what it prints.
+    Subclasses implement :meth:`run` and :meth:`parse`; keeping them
+    apart makes it possible to record the raw output of a real scan and
+    replay it later with :class:`ReplayBackend`.
+    '''
+
+    def __call__(self):
+        return self.parse(self.run())
+
+    def run(self):
+        '''Scan, returning the raw output of the platform tool'''
+        raise NotImplementedError
+
+    def parse(self, output):
+        '''Turn the output of :meth:`run` into a dict mapping SignalNode
+        keys to SignalNodes'''
+        raise NotImplementedError
+
+def _interpret_DB(signal_string):
     '''
     Most platforms (nm-tool doesn't for some reason) return the Received Signal Strength Indication (RSSI) in dBm units (http://en.wikipedia.org/wiki/DBm)
     The following is a convenient way to indicate, for example, that -85 is weaker than -10
     '''
     return 100 + int(signal_string)
 
-def __getExePath():
+def _getExePath():
     return '..\\windowsGetWirelessStrength\\Get Wireless Strengths\\bin\\Release\\'
 
-def __get_signal_nodes_win():
-    signal_nodes_dict = dict()
-    # Should work on Windows > XP SP3
-    o = subprocess.Popen(os.path.join(__getExePath(), 'Get Wireless Strengths.exe'), stderr=subprocess.PIPE, stdout=subprocess.PIPE,shell=True).stdout#shell=true hides shell
-    res = o.read()
-    o.close()
-    data = json.loads(res)
-    for row in data:
-        RSSI,SSID,BSSID = row['RSSI'], row['SSID'],row['BSSID']
-        if 'OLIN' in SSID and 'GUEST' not in SSID: #Only take into account OLIN wifi and non-guest WIFI
-            curr_node = SignalNode(BSSID, SSID, __interpret_DB(RSSI))
-            signal_nodes_dict[curr_node.identifier] = curr_node
-    return signal_nodes_dict
-
-def __get_signal_nodes_mac():
-    import plistlib
-    # '/System/Library/PrivateFrameworks/Apple80211.framework/Resources/airport -s -x'
-    # This is an undocumented system utility available on Mac OS X
-    # From the included help:
-    # -s[<arg>] --scan=[<arg>]       Perform a wireless broadcast scan.
-    #           Will perform a directed scan if the optional <arg> is provided
-    # -x        --xml                Print info as XML
-    signal_nodes_dict = dict()
-
-    ntwks = list()
-    try:
-        # Get information about networks
-        cmd = '/System/Library/PrivateFrameworks/Apple80211.framework/Resources/airport'
-        o = subprocess.Popen(['/System/Library/PrivateFrameworks/Apple80211.framework/Resources/airport', '-s', '-x'], stdout=subprocess.PIPE).stdout
-        ntwks = plistlib.readPlist(o)
-    except Exception as e:
-        print "Failed to find networks.  The command '%s' may not exist." % '/System/Library/PrivateFrameworks/Apple80211.framework/Resources/airport'
-        print "Traceback is:\n%s" % e
-
-    for network in ntwks:
-        if 'OLIN' in network['SSID_STR'] and 'GUEST' not in network['SSID_STR']:
-            # Now we are pretty sure that this is a non-guest Olin network
-            # Unless someone else has a router with 'OLIN' in the SSID
-
-            # The BSSID (MAC address) is of the form 0:20:d8:2d:65:2
-            # Now we need to convert it to the format 00:20:D8:2D:65:20
-            macbytes = network['BSSID'].split(':')
-            bssid = list()
-            for byte in macbytes:
-                if len(byte) < 2:
-                    bssid.append(('0%s' % byte).upper())
-                else:
-                    bssid.append(byte.upper())
-            curr_node = SignalNode(':'.join(bssid), network['SSID_STR'], __interpret_DB(network['RSSI']))
-            signal_nodes_dict[curr_node.identifier] = curr_node
-    return signal_nodes_dict
+class WindowsBackend(CommandBackend):
+    '''Uses the bundled 'Get Wireless Strengths.exe', which prints JSON.
+    Should work on Windows > XP SP3'''
+
+    def run(self):
+        o = subprocess.Popen(os.path.join(_getExePath(), 'Get Wireless Strengths.exe'), stderr=subprocess.PIPE, stdout=subprocess.PIPE,shell=True).stdout#shell=true hides shell
+        res = o.read()
+        o.close()
+        return res
+
+    def parse(self, output):
+        signal_nodes_dict = dict()
+        data = json.loads(output)
+        for row in data:
+            RSSI,SSID,BSSID = row['RSSI'], row['SSID'],row['BSSID']
+            if 'OLIN' in SSID and 'GUEST' not in SSID: #Only take into account OLIN wifi and non-guest WIFI
+                curr_node = SignalNode(BSSID, SSID, _interpret_DB(RSSI))
+                signal_nodes_dict[curr_node.key] = curr_node
+        return signal_nodes_dict
+
+_AIRPORT = '/System/Library/PrivateFrameworks/Apple80211.framework/Resources/airport'
 
-def __get_signal_nodes_network_manager():
+class AirportBackend(CommandBackend):
+    '''Uses the airport utility on Mac OS X, which prints a plist'''
+
+    def run(self):
+        # '/System/Library/PrivateFrameworks/Apple80211.framework/Resources/airport -s -x'
+        # This is an undocumented system utility available on Mac OS X
+        # From the included help:
+        # -s[<arg>] --scan=[<arg>]       Perform a wireless broadcast scan.
+        #           Will perform a directed scan if the optional <arg> is provided
+        # -x        --xml                Print info as XML
+        try:
+            # Get information about networks
+            return subprocess.Popen([_AIRPORT, '-s', '-x'], stdout=subprocess.PIPE).communicate()[0]
+        except Exception as e:
+            print "Failed to find networks.  The command '%s' may not exist." % _AIRPORT
+            print "Traceback is:\n%s" % e
+            return ''
+
+    def parse(self, output):
+        import plistlib
+        signal_nodes_dict = dict()
+
+        ntwks = list()
+        try:
+            ntwks = plistlib.readPlistFromString(output)
+        except Exception as e:
+            print "Failed to read the list of networks"
+            print "Traceback is:\n%s" % e
+
+        for network in ntwks:
+            if 'OLIN' in network['SSID_STR'] and 'GUEST' not in network['SSID_STR']:
+                # Now we are pretty sure that this is a non-guest Olin network
+                # Unless someone else has a router with 'OLIN' in the SSID
+
+                # The BSSID (MAC address) is of the form 0:20:d8:2d:65:2
+                # Now we need to convert it to the format 00:20:D8:2D:65:20
+                macbytes = network['BSSID'].split(':')
+                bssid = list()
+                for byte in macbytes:
+                    if len(byte) < 2:
+                        bssid.append(('0%s' % byte).upper())
+                    else:
+                        bssid.append(byte.upper())
+                curr_node = SignalNode(':'.join(bssid), network['SSID_STR'], _interpret_DB(network['RSSI']))
+                signal_nodes_dict[curr_node.key] = curr_node
+        return signal_nodes_dict
+
+# nmcli -t -f SSID,BSSID,SIGNAL dev wifi list
+# prints lines like  OLIN_WH:00\:26\:3E\:30\:2B\:82:72
+# Colons inside fields are escaped with a backslash; older versions
+# don't escape them but put quotes around the SSID instead.
+_NMCLI_LINE = re.compile(
+    r"^'?(?P<ssid>OLIN_(?:[^:\\\n]|\\.)*?)'?:"
+    r"(?P<bssid>(?:[0-9A-Fa-f]{2}\\?:){5}[0-9A-Fa-f]{2}):"
+    r"(?P<strength>\d+)\s*$", re.MULTILINE)
+_NMCLI_ESCAPE = re.compile(r"\\(.)")
+
+# nm-tool prints lines like
+#   *OLIN_WH:      Infra, 00:26:3E:30:2B:82, Freq 2442 MHz, Rate 54 Mb/s, Strength 25 WPA
+_NM_TOOL_LINE = re.compile(
+    r"^\s*\*?(?P<ssid>OLIN_[^:\n]*):[^,\n]*,\s*"
+    r"(?P<bssid>(?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}),"
+    r"[^\n]*?Strength\s+(?P<strength>\d+)", re.MULTILINE)
+
+class NetworkManagerBackend(CommandBackend):
     '''
-    Uses nm-tool on Linux to get the signal strength as a dict of SignalNode identifiers -> SignalNodes
+    Uses NetworkManager on Linux to get the signal strength as a dict of SignalNode keys -> SignalNodes
+
+    Spawns a single nmcli process (or nm-tool, on systems that are too old
+    to have nmcli) and parses its output in-process.
     Note: I couldn't find out the signal strength units. Hopefully they are compatible.
     '''
-    p1 = subprocess.Popen("nm-tool", stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(['grep', '-E', "(\*|\s)OLIN_"], stdin=p1.stdout, stdout=subprocess.PIPE)
-    p3 = subprocess.Popen(['grep', '-Eo', "OLIN_.*"], stdin=p2.stdout, stdout=subprocess.PIPE)
-    p1.stdout.close()
-    p2.stdout.close()
-    result = p3.communicate()[0].strip().split('\n')
-    p1.wait()
-    p2.wait()
-    signal_nodes_dict = dict()
-
-    for line in result:
-        # Format is now
-        # ['OLIN_GUEST:      Infra', ' 00:26:3E:30:2B:82', ' Freq 2442 MHz', ' Rate 54 Mb/s', ' Strength 25 WPA']
-        access_pt_info = line.split(',')
-        sepLoc = access_pt_info[0].find(':')
-        if sepLoc <= 0: #fail gracefully if we are parsing a line we shouldn't be...
-            continue
-        ssid = access_pt_info[0][:sepLoc]
-        bssid = access_pt_info[1].strip()
-        strength = int(access_pt_info[4].strip().split(' ')[1]) - 10 # As far as I can tell, this is the relationship to __interpret_DB's output - Julian
-        curr_node = SignalNode(bssid, ssid, strength)
-        signal_nodes_dict[curr_node.identifier] = curr_node
-    return signal_nodes_dict
+
+    def __init__(self):
+        self._nmcli_available = True  # Set to False the first time nmcli is missing
+
+    def run(self):
+        if self._nmcli_available:
+            try:
+                return subprocess.Popen(
+                    ['nmcli', '-t', '-f', 'SSID,BSSID,SIGNAL', 'dev', 'wifi', 'list'],
+                    stdout=subprocess.PIPE).communicate()[0]
+            except OSError:
+                self._nmcli_available = False
+        return subprocess.Popen('nm-tool', stdout=subprocess.PIPE).communicate()[0]
+
+    def parse(self, output):
+        if 'Strength' in output:
+            line_pattern = _NM_TOOL_LINE
+        else:
+            line_pattern = _NMCLI_LINE
+        signal_nodes_dict = dict()
+        for match in line_pattern.finditer(output):
+            bssid = match.group('bssid').replace('\\', '').upper()
+            ssid = match.group('ssid')
+            if line_pattern is _NMCLI_LINE:
+                ssid = _NMCLI_ESCAPE.sub(r'\1', ssid)  # i.e. OLIN_A\:B
+            # Both tools report strength as a percentage. As far as I can tell,
+            # this is the relationship to _interpret_DB's output - Julian
+            strength = int(match.group('strength')) - 10
+            curr_node = SignalNode(bssid, ssid, strength)
+            signal_nodes_dict[curr_node.key] = curr_node
+        return signal_nodes_dict
+
+class ReplayBackend(object):
+    '''
+    Plays back recorded scans instead of scanning, so that the whole
+    pipeline can be run and profiled on a machine without Wi-Fi.
+
+    Every file is the raw output of one scan, as saved by
+    :func:`record_scans`: nmcli or nm-tool text, airport plist XML or the
+    JSON printed by the Windows executable. The format is detected from
+    the contents of each file.
+
+    :param path: A recorded scan, or a directory of them which are played
+        back in order of file name
+    :type path: str
+    :param interval: Minimum number of seconds between two scans, to
+        mimic the time a real scan takes
+    :type interval: float
+    :param loop: Start over after the last recording instead of raising
+        StopIteration
+    :type loop: bool
+    '''
+
+    def __init__(self, path=None, interval=0, loop=True):
+        if not path:
+            raise ValueError("The replay backend needs a path to recorded scans")
+        if os.path.isdir(path):
+            self.paths = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                          if not name.startswith('.')]
+        else:
+            self.paths = [path]
+        self.interval = interval
+        self.loop = loop
+        self._position = 0
+        self._last_scan = None
+        self._lock = threading.Lock()
+        self._parsers = [WindowsBackend(), AirportBackend(), NetworkManagerBackend()]
+
+    def __call__(self):
+        with self._lock:
+            if self._position >= len(self.paths):
+                if not self.loop:
+                    raise StopIteration
+                self._position = 0
+            path = self.paths[self._position]
+            self._position += 1
+
+            if self._last_scan is not None:
+                wait = self._last_scan + self.interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            self._last_scan = time.time()
+
+        with open(path, 'rb') as recording:
+            return self.parse(recording.read())
+
+    def parse(self, output):
+        '''Parse the output of any of the platform tools'''
+        stripped = output.lstrip()
+        if stripped.startswith('['):
+            return self._parsers[0].parse(output)
+        elif stripped.startswith('<'):
+            return self._parsers[1].parse(output)
+        else:
+            return self._parsers[2].parse(output)
+
+def default_shared_scanner_path():
+    '''Where a :class:`scanhost.ScanHost` listens unless told otherwise:
+    in a directory under /run, which only root can create'''
+    run_directory = '/run' if os.path.isdir('/run') else '/var/run'
+    return os.path.join(run_directory, 'maraudersmap', 'scanner.sock')
+
+def check_shared_scanner_directory(directory):
+    '''
+    Make sure only root or the current user can create files in
+    `directory`, i.e. that it belongs to one of them and nobody else can
+    write to it.
+
+    :raises ValueError: if someone else could put a socket there
+    :raises OSError: if the directory doesn't exist
+    '''
+    if not hasattr(os, 'getuid'):
+        raise ValueError("Shared scanners need a Unix-like system")
+    directory_stat = os.stat(directory)
+    if directory_stat.st_uid not in (0, os.getuid()):
+        raise ValueError("%s belongs to another user" % directory)
+    if directory_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ValueError("Other users can write to %s" % directory)
+
+def check_shared_scanner(path):
+    '''
+    Make sure the socket at `path` was created by root or the current
+    user, in a directory that nobody else can write to. Otherwise any
+    user of the machine could put a socket there first and feed made up
+    scans to everyone else's client.
+
+    :raises ValueError: if the socket can't be trusted
+    :raises OSError: if there is no socket at `path`
+    '''
+    check_shared_scanner_directory(os.path.dirname(os.path.abspath(path)))
+    socket_stat = os.lstat(path)
+    if not stat.S_ISSOCK(socket_stat.st_mode):
+        raise ValueError("%s is not a socket" % path)
+    if socket_stat.st_uid not in (0, os.getuid()):
+        raise ValueError("%s belongs to another user" % path)
+
+class SharedBackend(object):
+    '''
+    Gets scans from the :class:`scanhost.ScanHost` running on this machine
+    instead of scanning, so that several users running the client at once
+    share one scan of the radio instead of scanning once each.
+
+    Every call returns a scan taken after the one returned by the previous
+    call, waiting for the host to make it if necessary. If no host is
+    running, or its socket fails :func:`check_shared_scanner`, it scans
+    with the platform's own backend instead, and tries the host again on
+    the next call.
+
+    :param path: The host's Unix socket
+    :type path: str
+    :param timeout: Seconds to wait for the host to answer
+    :type timeout: float
+    '''
+
+    def __init__(self, path=None, timeout=60):
+        self.path = path or default_shared_scanner_path()
+        self.timeout = timeout
+        self._last_scan = None  # Time of the last scan received
+        self._local_backend = None
+
+    def __call__(self):
+        try:
+            return self._fetch()
+        except (socket.error, OSError, ValueError) as e:
+            if self._local_backend is None:
+                print "No shared scanner at %s (%s); scanning locally" % (
+                    self.path, e)
+                self._local_backend = \
+                    _BACKEND_FACTORIES[_detect_backend_name()][0]()
+            return self._local_backend()
+
+    def _fetch(self):
+        check_shared_scanner(self.path)
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(self.path)
+            connection.sendall('scan %r\n' % (self._last_scan or 0))
+            answer = json.loads(connection.makefile().readline())
+        finally:
+            connection.close()
+        if 'error' in answer:
+            raise ValueError(answer['error'])
+        self._last_scan = answer['time']
+        nodes = [SignalNode(MAC_address, name, signal_strength)
+                 for MAC_address, name, signal_strength in answer['nodes']]
+        return dict((node.key, node) for node in nodes)
+
+def record_scans(directory, samples=10, tsleep=1.0):
+    '''
+    Save the raw output of `samples` scans of the current platform's
+    backend to `directory`, for use with :class:`ReplayBackend`.
+    '''
+    backend = _BACKEND_FACTORIES[_detect_backend_name()][0]()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for i in range(samples):
+        if i > 0:
+            time.sleep(tsleep)
+        with open(os.path.join(directory, 'scan%04i.txt' % i), 'wb') as recording:
+            recording.write(backend.run())
+
+register_backend('windows', WindowsBackend, platforms=('win',))
+# This should work on most recent versions of Linux, according to Riley - Julian
+register_backend('network_manager', NetworkManagerBackend, platforms=('linux',))
+register_backend('airport', AirportBackend, platforms=('darwin',))
+register_backend('replay', ReplayBackend)
+register_backend('shared', SharedBackend)
 
 if __name__ == '__main__':
-    # test code
-    print ";".join([str(node) for node in get_avg_signal_nodes(samples=3, tsleep=0.15)])
+    if len(sys.argv) > 2 and sys.argv[1] == 'record':
+        # python signal_strength.py record DIRECTORY
+        record_scans(sys.argv[2])
+    else:
+        # test code
+        print ";".join([str(node) for node in get_avg_signal_nodes(samples=3, tsleep=0.15)])
@@ -0,0 +1,72 @@
+"""Measures how long each phase of starting the client takes.
+
+Run the client with ``--startup-timing`` to print a breakdown once the
+first location is shown::
+
+    $ python mapclient.py --startup-timing
+    Startup timing:
+      imports                   412 ms  (at  412 ms)
+      settings                    3 ms  (at  415 ms)
+      tray icon shown            96 ms  (at  511 ms)
+      ...
+
+Phases are marked with :meth:`StartupTimer.mark` as they end; the time of
+a phase is the time since the previous mark, starting from when this
+module was imported.
+"""
+
+import threading
+import time
+
+
+class StartupTimer(object):
+    """Records when each startup phase ended.
+
+    :param enabled: Whether :meth:`finish` prints the breakdown
+    :type enabled: bool
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._marks = list()  # (phase, time it ended)
+        self._finished = False
+
+    def mark(self, phase):
+        """Note that `phase` has just ended. Can be called from any thread.
+        """
+        with self._lock:
+            if not self._finished:
+                self._marks.append((phase, time.time()))
+
+    def phases(self):
+        """:returns: list of (phase, seconds it took, seconds since start)
+            tuples, in the order they ended
+        """
+        with self._lock:
+            marks = list(self._marks)
+        result = list()
+        previous = self.started_at
+        for phase, ended_at in marks:
+            result.append((phase, ended_at - previous,
+                           ended_at - self.started_at))
+            previous = ended_at
+        return result
+
+    def finish(self):
+        """Stop recording and, if enabled, print the breakdown. Only the
+        first call does anything.
+        """
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        if self.enabled:
+            print "Startup timing:"
+            for phase, duration, elapsed in self.phases():
+                print "  %-24s %6i ms  (at %6i ms)" % (
+                    phase, duration * 1000, elapsed * 1000)
+
+
+timer = StartupTimer()
@@ -0,0 +1,130 @@
+"""A persistent on-disk cache for the replicas in :mod:`sync`.
+
+Records are kept in an SQLite database called ``cache.sqlite`` next to
+``config.txt`` in the preferences directory, so that a freshly started
+client can find the nearest bind and name the place it belongs to before
+it has talked to the server at all.
+
+The database stores, for every collection, the JSON of each record and
+the validators (``ETag``, ``Last-Modified``, ``since`` cursor) needed to
+revalidate it later. Whenever :attr:`Store.SCHEMA_VERSION` changes, an
+existing database with an older layout is thrown away and rebuilt.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+from configuration import Settings
+
+
+class Store(object):
+    """An SQLite-backed record cache.
+
+    :param path: Location of the database file
+    :type path: str
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Replicas are refreshed from worker threads, so the connection is
+        # shared between threads and serialized with self._lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock:
+            version = self._db.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.SCHEMA_VERSION:
+                self._db.execute('DROP TABLE IF EXISTS records')
+                self._db.execute('DROP TABLE IF EXISTS collections')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                ' collection TEXT NOT NULL,'
+                ' key TEXT NOT NULL,'
+                ' data TEXT NOT NULL,'
+                ' PRIMARY KEY (collection, key))')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS collections ('
+                ' collection TEXT PRIMARY KEY,'
+                ' etag TEXT,'
+                ' last_modified TEXT,'
+                ' cursor TEXT,'
+                ' refreshed_at REAL)')
+            self._db.execute('PRAGMA user_version = %i' % self.SCHEMA_VERSION)
+            self._db.commit()
+
+    def load(self, collection):
+        """Read a collection back from disk.
+
+        :returns: tuple of (list of record dicts, dict of validators). The
+            validators dict has the keys ``etag``, ``last_modified``,
+            ``cursor`` and ``refreshed_at`` and is empty if the collection
+            was never saved.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT data FROM records WHERE collection = ?',
+                (collection,)).fetchall()
+            meta = self._db.execute(
+                'SELECT etag, last_modified, cursor, refreshed_at '
+                'FROM collections WHERE collection = ?',
+                (collection,)).fetchone()
+        records = [json.loads(row[0]) for row in rows]
+        if meta is None:
+            return records, dict()
+        return records, dict(zip(
+            ('etag', 'last_modified', 'cursor', 'refreshed_at'), meta))
+
+    def save(self, collection, records, key, etag=None, last_modified=None,
+             cursor=None, refreshed_at=None):
+        """Replace everything stored for `collection`.
+
+        :param records: The record dicts to store
+        :type records: list
+        :param key: Name of the field that uniquely identifies a record
+        :type key: str
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM records WHERE collection = ?',
+                             (collection,))
+            self._db.executemany(
+                'INSERT INTO records (collection, key, data) VALUES (?, ?, ?)',
+                [(collection, unicode(record[key]), json.dumps(record))
+                 for record in records])
+            self._save_meta(collection, etag, last_modified, cursor,
+                            refreshed_at)
+            self._db.commit()
+
+    def touch(self, collection, etag=None, last_modified=None, cursor=None,
+              refreshed_at=None):
+        """Update only the validators of `collection`, i.e. after the
+        server answered ``304 Not Modified``.
+        """
+        with self._lock:
+            self._save_meta(collection, etag, last_modified, cursor,
+                            refreshed_at)
+            self._db.commit()
+
+    def _save_meta(self, collection, etag, last_modified, cursor,
+                   refreshed_at):
+        self._db.execute(
+            'INSERT OR REPLACE INTO collections '
+            '(collection, etag, last_modified, cursor, refreshed_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (collection, etag, last_modified, cursor, refreshed_at))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_default_store():
+    """Open (creating it if necessary) the cache in the preferences
+    directory. :meth:`Settings.init` must have been called first.
+    """
+    return Store(os.path.join(Settings.DATA_DIR, 'cache.sqlite'))
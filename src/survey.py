@@ -0,0 +1,209 @@
+"""Record the fingerprints of a building without a connection to the
+server, and upload them as binds later.
+
+Surveying with the bind creation view of the web client needs a
+connection at every spot, and puts the signals in the url, which gets too
+long where there are many access points. Instead, a :class:`SurveyLog`
+appends one JSON object per line to a local file for every spot surveyed,
+with the time, the place, the x and y coordinates on the map, every raw
+sample and their outlier-filtered average (see
+:class:`signal_strength.SampleMatrix`)::
+
+    {"time": 1377000000.0, "username": "jceipek",
+     "place": {"name": "lounge", "floor": "EH4"}, "x": 0.85, "y": 0.77,
+     "samples": [{"00:11:22:33:44:55": 62, ...}, ...],
+     "signals": {"00:11:22:33:44:55": 61, ...}}
+
+The place is either the id of an existing place or its name and floor,
+in which case it is looked up (or created) when the log is uploaded.
+
+:func:`upload` turns the log into binds with :func:`client_api.post_binds`
+and writes the line numbers that made it to a ``.uploaded`` file next to
+the log, so an interrupted upload can simply be run again.
+
+From the command line::
+
+    python survey.py record LOG PLACE_ID X Y [SAMPLES]
+    python survey.py record LOG NAME@FLOOR X Y [SAMPLES]
+    python survey.py upload LOG
+
+"""
+
+import json
+import os
+import sys
+import time
+from getpass import getuser
+
+import client_api
+import signal_strength
+from configuration import Settings
+
+
+class SurveyLog(object):
+    """An append-only log of surveyed fingerprints.
+
+    :param path: The log file; created on the first :meth:`record`
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, place, x, y, samples=10, tsleep=1.0, username=None):
+        """Scan `samples` times at the current spot and append the result.
+
+        :param place: The id of an existing place, or a dict with its
+            ``name`` and ``floor``
+        :param x: Horizontal position on the map, from 0 to 1
+        :type x: float
+        :param y: Vertical position on the map, from 0 to 1
+        :type y: float
+        :returns: The entry that was written, as a dict
+        """
+        scanner = signal_strength.Scanner(samples=samples)
+        raw_samples = list()
+        for i in range(samples):
+            if i > 0:
+                time.sleep(tsleep)
+            nodes_dict = signal_strength.get_signal_node_dict()
+            raw_samples.append(dict((node.MAC_address, node.signal_strength)
+                                    for node in nodes_dict.itervalues()))
+            scanner.add_sample(nodes_dict)
+
+        entry = {'time': time.time(),
+                 'username': username or getuser(),
+                 'place': place,
+                 'x': x,
+                 'y': y,
+                 'samples': raw_samples,
+                 'signals': scanner.signals_dict()}
+        self.append(entry)
+        return entry
+
+    def append(self, entry):
+        """Write `entry` at the end of the log."""
+        with open(self.path, 'a') as log_file:
+            log_file.write(json.dumps(entry))
+            log_file.write('\n')
+            log_file.flush()
+            os.fsync(log_file.fileno())
+
+    def entries(self):
+        """Read the log back.
+
+        :returns: list of (line number, entry dict) tuples. A line that
+            was cut short, i.e. by a crash while it was written, is skipped.
+        """
+        if not os.path.isfile(self.path):
+            return list()
+        entries = list()
+        with open(self.path) as log_file:
+            for line_number, line in enumerate(log_file):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append((line_number, json.loads(line)))
+                except ValueError:
+                    print "Skipping unreadable survey entry on line %i" % (
+                        line_number + 1)
+        return entries
+
+    @property
+    def uploaded_path(self):
+        """Where the line numbers of uploaded entries are kept"""
+        return self.path + '.uploaded'
+
+    def uploaded(self):
+        """The line numbers of the entries that were already uploaded"""
+        if not os.path.isfile(self.uploaded_path):
+            return set()
+        with open(self.uploaded_path) as uploaded_file:
+            return set(int(line) for line in uploaded_file if line.strip())
+
+    def mark_uploaded(self, line_numbers):
+        with open(self.uploaded_path, 'a') as uploaded_file:
+            for line_number in line_numbers:
+                uploaded_file.write('%i\n' % line_number)
+
+
+def upload(log, chunk_size=100, max_in_flight=2):
+    """Upload every entry of `log` that wasn't uploaded before as a bind.
+
+    :type log: :class:`SurveyLog`
+    :returns: list of (entry dict, exception) tuples for the entries that
+        failed; run :func:`upload` again to retry them
+    """
+    done = log.uploaded()
+    entries = [(line_number, entry) for line_number, entry in log.entries()
+               if line_number not in done]
+
+    failures = list()
+    binds = list()
+    sources = dict()  # id(bind) -> (line number, entry)
+    place_ids = dict()
+    for line_number, entry in entries:
+        try:
+            place_id = _resolve_place(entry['place'], place_ids)
+        except Exception as e:
+            failures.append((entry, e))
+            continue
+        bind = client_api.Bind(username=entry['username'], place=place_id,
+                               signals=entry['signals'],
+                               x=entry['x'], y=entry['y'])
+        binds.append(bind)
+        sources[id(bind)] = (line_number, entry)
+
+    bind_failures = client_api.post_binds(binds, chunk_size=chunk_size,
+                                          max_in_flight=max_in_flight)
+    # Only binds the server gave an id were stored
+    log.mark_uploaded(sources[id(bind)][0] for bind in binds
+                      if bind._d.get('id') is not None)
+    failures.extend((sources[id(bind)][1], error)
+                    for bind, error in bind_failures)
+    return failures
+
+
+def _resolve_place(place, place_ids):
+    if not isinstance(place, dict):
+        return place
+    key = (place['name'], place['floor'])
+    if key not in place_ids:
+        matches = client_api.get_places(name=place['name'],
+                                        floor=place['floor'])
+        if matches:
+            place_ids[key] = matches[0].id
+        else:
+            new_place = client_api.Place(name=place['name'],
+                                         floor=place['floor'],
+                                         alias=place.get('alias', place['name']))
+            new_place.post()
+            place_ids[key] = new_place.id
+    return place_ids[key]
+
+
+def _parse_place(argument):
+    if '@' in argument:
+        name, floor = argument.rsplit('@', 1)
+        return {'name': name, 'floor': floor}
+    return argument
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 6 and sys.argv[1] == 'record':
+        samples = int(sys.argv[6]) if len(sys.argv) > 6 else 10
+        entry = SurveyLog(sys.argv[2]).record(
+            _parse_place(sys.argv[3]), float(sys.argv[4]), float(sys.argv[5]),
+            samples=samples)
+        print "Recorded %i access points" % len(entry['signals'])
+    elif len(sys.argv) == 3 and sys.argv[1] == 'upload':
+        Settings.init()
+        failures = upload(SurveyLog(sys.argv[2]))
+        for entry, error in failures:
+            print "Failed to upload %s: %s" % (entry['place'], error)
+        if failures:
+            sys.exit(1)
+    else:
+        print __doc__
+        sys.exit(2)
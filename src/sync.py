@@ -0,0 +1,247 @@
+"""Local replicas of the server's binds, places and users.
+
+A :class:`Replica` downloads a collection once and afterwards only asks the
+server for what changed:
+
+    * The ``ETag`` and ``Last-Modified`` headers of the last response are
+      sent back as ``If-None-Match`` and ``If-Modified-Since``, so when
+      nothing changed the server answers ``304 Not Modified`` with no body.
+    * If the server returned a ``cursor`` with the last response, it is
+      passed as ``since=<cursor>``. A server that supports this answers with
+      only the records that changed (plus a list of ``deleted`` ids) and
+      echoes ``since`` back; those changes are merged into the replica in
+      place. Servers that ignore ``since`` return the whole collection,
+      which simply replaces the replica.
+
+Replicas can be backed by a :class:`store.Store`, which lets a cold start
+use the binds and places from the last run without any network traffic;
+:meth:`Replica.revalidate` then refreshes stale replicas in the
+background.
+
+.. code-block:: python
+
+    import sync
+    sync.open_cache()  # Optional: load what was saved by the last run
+    sync.binds.refresh()
+    for bind in sync.binds.values():
+        print bind
+
+"""
+
+import json
+import threading
+import time
+
+import client_api
+import store
+from configuration import Settings
+from transport import get_transport
+
+
+class Replica(object):
+    """A local copy of one collection on the server.
+
+    :param collection: Name of the collection, used both in the url
+        (i.e. ``/binds/``) and as the key of the list in the response
+    :type collection: str
+    :param factory: Class used to create new records, i.e.
+        :class:`client_api.Bind`
+    :type factory: type
+    :param key: Name of the field that uniquely identifies a record
+    :type key: str
+    """
+
+    def __init__(self, collection, factory, key='id'):
+        self.collection = collection
+        self._factory = factory
+        self._key = key
+        self._lock = threading.Lock()
+        self._objects = dict()
+        self._etag = None
+        self._last_modified = None
+        self._cursor = None
+        self._store = None
+        # Not _lock, which is held for the whole of a refresh; revalidate
+        # must not wait for a refresh that is already running
+        self._revalidate_lock = threading.Lock()
+        self._revalidating = False
+        self.last_refreshed = None
+        self.version = 0  # Incremented every time the contents change
+
+    def attach(self, record_store):
+        """Back the replica with `record_store`: load whatever it holds
+        for this collection now, and save to it after every refresh.
+
+        :type record_store: :class:`store.Store`
+        """
+        records, meta = record_store.load(self.collection)
+        with self._lock:
+            self._store = record_store
+            if records and not self._objects:
+                self._merge(records, [])
+                self._etag = meta.get('etag')
+                self._last_modified = meta.get('last_modified')
+                self._cursor = meta.get('cursor')
+                self.last_refreshed = meta.get('refreshed_at')
+                self.version += 1
+
+    def refresh(self, max_age=0):
+        """Bring the replica up to date with the server.
+
+        :param max_age: Skip the request if the replica was refreshed less
+            than this many seconds ago
+        :type max_age: float
+
+        :returns: True if the contents of the replica changed
+        """
+        with self._lock:
+            if (self.last_refreshed is not None and
+                    time.time() - self.last_refreshed < max_age):
+                return False
+
+            headers = dict()
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+            params = dict()
+            if self._cursor:
+                params['since'] = self._cursor
+
+            r = get_transport().get(
+                '%s/%s/' % (Settings.SERVER_ADDRESS, self.collection),
+                params=params, headers=headers,
+                cookies=client_api.get_cookies())
+            self.last_refreshed = time.time()
+
+            if r.status_code == 304:
+                self._save(records_changed=False)
+                return False
+
+            response = json.loads(r.text)
+            records = response[self.collection]
+            if self._cursor and 'since' in response:
+                changed = self._merge(records, response.get('deleted', []))
+            else:
+                changed = self._replace(records)
+
+            self._etag = r.headers.get('etag')
+            self._last_modified = r.headers.get('last-modified')
+            self._cursor = response.get('cursor')
+            if changed:
+                self.version += 1
+            self._save(records_changed=changed)
+            return changed
+
+    def _save(self, records_changed):
+        if self._store is None:
+            return
+        meta = dict(etag=self._etag, last_modified=self._last_modified,
+                    cursor=self._cursor, refreshed_at=self.last_refreshed)
+        if records_changed:
+            self._store.save(self.collection,
+                             [dict(obj._d) for obj in self._objects.values()],
+                             self._key, **meta)
+        else:
+            self._store.touch(self.collection, **meta)
+
+    def is_stale(self, ttl):
+        """True if the replica is empty or was last refreshed more than
+        `ttl` seconds ago.
+        """
+        return (not self._objects or self.last_refreshed is None or
+                time.time() - self.last_refreshed >= ttl)
+
+    def revalidate(self, ttl):
+        """Make sure the replica is usable and not older than `ttl`.
+
+        An empty replica is refreshed right away, since there is nothing
+        to answer from. A stale one keeps answering from what it has while
+        it is refreshed on a background thread.
+        """
+        if not self._objects:
+            self.refresh()
+            return
+        with self._revalidate_lock:
+            # Two threads revalidating at once must not both start a refresh
+            if self._revalidating or not self.is_stale(ttl):
+                return
+            self._revalidating = True
+        thread = threading.Thread(target=self._background_refresh,
+                                  args=(ttl,))
+        thread.daemon = True
+        thread.start()
+
+    def _background_refresh(self, ttl):
+        try:
+            self.refresh(max_age=ttl)
+        except Exception as e:
+            print "Failed to revalidate %s" % self.collection
+            print e
+        finally:
+            with self._revalidate_lock:
+                self._revalidating = False
+
+    def _merge(self, records, deleted_ids):
+        changed = False
+        for record in records:
+            existing = self._objects.get(record[self._key])
+            if existing is None:
+                self._objects[record[self._key]] = self._factory(**record)
+                changed = True
+            elif existing._update(record):
+                changed = True
+        for identifier in deleted_ids:
+            if self._objects.pop(identifier, None) is not None:
+                changed = True
+        return changed
+
+    def _replace(self, records):
+        ids = set(record[self._key] for record in records)
+        changed = self._merge(records, [])
+        for identifier in self._objects.keys():
+            if identifier not in ids:
+                del self._objects[identifier]
+                changed = True
+        return changed
+
+    def get(self, identifier, default=None):
+        """Returns the record with the given id (or username, for users),
+        without a network request.
+        """
+        return self._objects.get(identifier, default)
+
+    def values(self):
+        """Returns a list of every record in the replica."""
+        with self._lock:
+            return self._objects.values()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def clear(self):
+        """Forget everything so that the next refresh downloads the whole
+        collection.
+        """
+        with self._lock:
+            self._objects = dict()
+            self._etag = None
+            self._last_modified = None
+            self._cursor = None
+            self.last_refreshed = None
+            self.version += 1
+
+
+def open_cache():
+    """Back every replica with the on-disk cache in the preferences
+    directory (see :func:`store.open_default_store`).
+    """
+    record_store = store.open_default_store()
+    for replica in (binds, places, users):
+        replica.attach(record_store)
+    return record_store
+
+
+binds = Replica('binds', client_api.Bind)
+places = Replica('places', client_api.Place)
+users = Replica('users', client_api.User, key='username')
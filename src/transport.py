@@ -0,0 +1,185 @@
+"""A shared, pooled HTTP session for talking to the Marauder's Map server.
+
+Every call in :mod:`client_api` goes through the :class:`Transport` returned
+by :func:`get_transport` instead of the module level ``requests.get`` and
+friends, so TCP (and TLS) connections are kept alive and reused between
+location updates rather than being opened from scratch every time.
+
+.. code-block:: python
+
+    import transport
+    r = transport.get_transport().get('http://map.fwol.in/api/users/')
+    print transport.get_transport().stats()
+
+"""
+
+import threading
+import time
+import urllib
+
+from configuration import Settings
+from metrics import request_metrics
+
+
+class Transport(object):
+    """A thread-safe wrapper around a single :class:`requests.Session`.
+
+    :param pool_connections: Number of per-host connection pools to keep
+        around (one per server address in practice)
+    :type pool_connections: int
+    :param pool_maxsize: Maximum number of connections kept open to a
+        single host. Requests beyond this limit wait for a free connection.
+    :type pool_maxsize: int
+    :param timeout: Seconds to wait for the server before giving up, unless
+        a request passes its own `timeout`. This keeps worker threads from
+        hanging forever on a dead server.
+    :type timeout: float
+    """
+
+    def __init__(self, pool_connections=2, pool_maxsize=4, timeout=15):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._session = None
+
+    @property
+    def session(self):
+        """The underlying :class:`requests.Session`, created on first use.
+        """
+        with self._lock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    def _create_session(self):
+        # requests takes a while to import, so it is only imported once the
+        # first request is made rather than when the client starts
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        for scheme in ('http://', 'https://'):
+            session.mount(scheme, HTTPAdapter(
+                pool_connections=self.pool_connections,
+                pool_maxsize=self.pool_maxsize,
+                pool_block=True))
+        # Keep-alive is the default, but be explicit about it
+        session.headers['Connection'] = 'keep-alive'
+        return session
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the pooled session.
+
+        Takes the same arguments as :func:`requests.request`. Every request
+        is recorded in :data:`metrics.request_metrics`.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        started_at = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            request_metrics.record(
+                method, url, elapsed=time.time() - started_at,
+                bytes_sent=_body_size(kwargs.get('data')))
+            raise
+        request_metrics.record(
+            method, url, status_code=response.status_code,
+            elapsed=time.time() - started_at,
+            bytes_sent=_body_size(kwargs.get('data')),
+            bytes_received=len(response.content))
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def stats(self):
+        """Connection counters for the pools that are currently open.
+
+        :returns: dict with the keys ``requests``, ``connections_opened``
+            and ``connections_reused``
+        """
+        opened = 0
+        sent = 0
+        with self._lock:
+            if self._session is not None:
+                for adapter in self._session.adapters.values():
+                    pools = adapter.poolmanager.pools
+                    for key in pools.keys():
+                        pool = pools.get(key)
+                        if pool is None:
+                            continue
+                        opened += pool.num_connections
+                        sent += pool.num_requests
+        return {'requests': sent,
+                'connections_opened': opened,
+                'connections_reused': max(sent - opened, 0)}
+
+    def close(self):
+        """Close every pooled connection. The session is recreated
+        on the next request.
+        """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+def _body_size(data):
+    # Only measured for the metrics, once the request has been sent, so
+    # this must never raise
+    try:
+        if data is None:
+            return 0
+        if isinstance(data, dict):
+            # requests form-encodes dicts, as UTF-8; urlencode would raise
+            # on non-ASCII unicode
+            return len(urllib.urlencode([(_utf8(key), _utf8(value))
+                                         for key, value in data.iteritems()]))
+        return len(_utf8(data))
+    except Exception:
+        return 0
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """Returns the process-wide :class:`Transport`, creating it from
+    :attr:`Settings.POOL_CONNECTIONS` and :attr:`Settings.POOL_MAXSIZE`
+    the first time it is needed.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport(
+                pool_connections=Settings.POOL_CONNECTIONS,
+                pool_maxsize=Settings.POOL_MAXSIZE)
+        return _transport
+
+
+def reset_transport():
+    """Close the shared transport so that the next call to
+    :func:`get_transport` picks up changed pool settings.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is not None:
+            _transport.close()
+        _transport = None
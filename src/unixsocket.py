@@ -0,0 +1,137 @@
+"""Line-based servers on Unix sockets, for controlling the client from
+other processes on the same machine.
+
+A :class:`LineServer` reads one command per line and answers each with a
+line of JSON. Both the daemon (:mod:`headless`) and the scan host
+(:mod:`scanhost`) use one.
+
+A process that doesn't exit cleanly leaves its socket file behind, and a
+new server can't bind to the path until that file is removed. Before
+removing it, :func:`claim` connects to it: only if nobody answers is the
+file left over. A server that is still running keeps its socket.
+
+.. code-block:: python
+
+    import unixsocket
+    server = unixsocket.LineServer('/tmp/echo.sock',
+                                   lambda line: {'echo': line}).start()
+    print unixsocket.send_line('/tmp/echo.sock', 'hello')
+    server.close()
+
+"""
+
+import errno
+import json
+import os
+import socket
+import threading
+from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+
+class Socket_In_Use_Error(Exception):
+    """Another process is serving on the socket already."""
+    pass
+
+
+def claim(path):
+    """Make `path` free to bind to, removing a socket that was left over
+    by a process that didn't exit cleanly.
+
+    :raises Socket_In_Use_Error: if a server answers on `path`
+    """
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as e:
+        if e.errno == errno.ENOENT:
+            # Removed since we looked
+            return
+        if e.errno != errno.ECONNREFUSED:
+            raise
+        os.remove(path)
+    else:
+        raise Socket_In_Use_Error("Something is serving on %s already" % path)
+    finally:
+        probe.close()
+
+
+def send_line(path, line, timeout=None):
+    """Send one command to the :class:`LineServer` at `path`.
+
+    :returns: The answer, decoded from JSON
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.settimeout(timeout)
+        connection.connect(path)
+        connection.sendall(line + '\n')
+        answer = connection.makefile().readline()
+    finally:
+        connection.close()
+    return json.loads(answer)
+
+
+class LineServer(ThreadingMixIn, UnixStreamServer):
+    """Answers every line sent to the Unix socket at `path`, on
+    background threads.
+
+    :param handle_line: Called with each non-empty line, stripped; returns
+        what to answer with, which must be serializable as JSON
+    :type handle_line: function
+    :param timeout: Seconds a connection may stay idle before it is closed
+    :type timeout: float
+    :param mode: Permissions of the socket file
+    :type mode: int
+    :raises Socket_In_Use_Error: if another server is running on `path`
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, handle_line, timeout=10, mode=0600):
+        claim(path)
+        UnixStreamServer.__init__(self, path, _LineHandler)
+        os.chmod(path, mode)
+        self.path = path
+        self.handle_line = handle_line
+        self.idle_timeout = timeout
+        self._thread = None
+
+    def start(self):
+        """Start serving on a background thread.
+
+        :returns: the server itself
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop serving and remove the socket."""
+        if self._thread is not None:
+            # Only returns once serve_forever does, so it would never
+            # return if that wasn't running
+            self.shutdown()
+            self._thread = None
+        self.server_close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class _LineHandler(StreamRequestHandler):
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout
+        StreamRequestHandler.setup(self)
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            answer = self.server.handle_line(line)
+            self.wfile.write(json.dumps(answer) + '\n')
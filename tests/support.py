@@ -0,0 +1,38 @@
+"""Helpers shared by the tests.
+
+Importing this module puts ``src`` on the path, so the tests import the
+client's modules the way the client does.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+import configuration
+from configuration import Settings
+
+
+def init_temporary_settings():
+    """:meth:`Settings.init` with the preferences directory in a new
+    temporary directory, so the tests never touch the user's settings.
+
+    :returns: The temporary directory; pass it to
+        :func:`remove_temporary_settings` when done
+    """
+    directory = tempfile.mkdtemp()
+    user_data_dir = configuration.appdirs.user_data_dir
+    configuration.appdirs.user_data_dir = lambda *args, **kwargs: directory
+    try:
+        Settings.init()
+    finally:
+        configuration.appdirs.user_data_dir = user_data_dir
+    return directory
+
+
+def remove_temporary_settings(directory):
+    Settings.flush()
+    shutil.rmtree(directory, ignore_errors=True)
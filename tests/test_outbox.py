@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+import client_api
+import outbox
+
+
+class FakeServer(object):
+    """Stands in for :func:`client_api.post_positions`, accepting only
+    the first `accept` positions of every upload."""
+
+    def __init__(self, accept=None):
+        self.accept = accept
+        self.uploads = list()
+        self.next_id = 1
+
+    def post_positions(self, positions):
+        self.uploads.append([p._upload_dict()['bind'] for p in positions])
+        accepted = positions if self.accept is None else positions[:self.accept]
+        for position in accepted:
+            position.id = self.next_id
+            self.next_id += 1
+        if len(accepted) < len(positions):
+            raise client_api.Incomplete_Batch_Error()
+
+
+def at(bind, username='jceipek'):
+    return client_api.Position(username=username, bind=bind)
+
+
+class PositionOutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox.jsonl')
+        self.server = FakeServer()
+        self.post_positions = client_api.post_positions
+        client_api.post_positions = self.server.post_positions
+
+    def tearDown(self):
+        client_api.post_positions = self.post_positions
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_coalesces_the_same_place(self):
+        positions = outbox.PositionOutbox()
+        self.assertTrue(positions.add(at(1)))
+        self.assertFalse(positions.add(at(1)))
+        self.assertTrue(positions.add(at(1, username='someone')))
+        self.assertTrue(positions.add(at(2)))
+        self.assertEqual(len(positions), 3)
+
+    def test_drops_the_oldest_beyond_max_size(self):
+        positions = outbox.PositionOutbox(max_size=3)
+        for bind in range(5):
+            positions.add(at(bind))
+        positions.flush()
+        self.assertEqual(self.server.uploads, [[2, 3, 4]])
+
+    def test_flush_uploads_everything_once(self):
+        positions = outbox.PositionOutbox()
+        positions.add(at(1))
+        positions.add(at(2))
+        positions.flush()
+        positions.flush()
+        self.assertEqual(self.server.uploads, [[1, 2]])
+        self.assertEqual(len(positions), 0)
+
+    def test_partial_upload_only_resends_what_was_not_accepted(self):
+        positions = outbox.PositionOutbox()
+        for bind in range(3):
+            positions.add(at(bind))
+        self.server.accept = 1
+        self.assertRaises(client_api.Incomplete_Batch_Error, positions.flush)
+        self.server.accept = None
+        positions.flush()
+        self.assertEqual(self.server.uploads, [[0, 1, 2], [1, 2]])
+
+    def test_waiting_positions_survive_a_restart(self):
+        positions = outbox.PositionOutbox(path=self.path)
+        positions.add(at(1))
+        positions.add(at(2))
+        positions.close()
+        positions = outbox.PositionOutbox(path=self.path)
+        positions.flush()
+        positions.close()
+        self.assertEqual(self.server.uploads, [[1, 2]])
+
+    @unittest.skipIf(outbox.fcntl is None, "Outbox files are not locked")
+    def test_only_one_outbox_uses_a_file(self):
+        positions = outbox.PositionOutbox(path=self.path)
+        self.assertRaises(outbox.Outbox_In_Use_Error,
+                          outbox.PositionOutbox, path=self.path)
+        positions.close()
+        outbox.PositionOutbox(path=self.path).close()
+
+
+if __name__ == '__main__':
+    unittest.main()
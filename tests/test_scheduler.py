@@ -0,0 +1,56 @@
+import time
+import unittest
+
+import support
+from scheduler import AdaptiveScheduler
+
+HERE = {'00:11:22:33:44:55': -40, '00:11:22:33:44:66': -70}
+ELSEWHERE = {'00:11:22:33:44:55': -85, '00:11:22:33:44:77': -45}
+
+
+class AdaptiveSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = AdaptiveScheduler(min_interval=10, max_interval=80,
+                                           max_refresh_interval=300,
+                                           threshold=10.0, backoff=2.0)
+
+    def test_first_check_asks_for_a_refresh(self):
+        self.assertTrue(self.scheduler.check(HERE))
+
+    def test_backs_off_while_the_user_stays_put(self):
+        self.scheduler.mark_refreshed(HERE)
+        intervals = list()
+        for _ in range(5):
+            self.assertFalse(self.scheduler.check(HERE))
+            intervals.append(self.scheduler.next_interval)
+        self.assertEqual(intervals, [20, 40, 80, 80, 80])
+
+    def test_a_move_asks_for_a_refresh_and_checks_often_again(self):
+        self.scheduler.mark_refreshed(HERE)
+        self.scheduler.check(HERE)
+        self.scheduler.check(HERE)
+        self.assertTrue(self.scheduler.check(ELSEWHERE))
+        self.assertEqual(self.scheduler.next_interval, 10)
+
+    def test_keeps_asking_until_the_refresh_starts(self):
+        # i.e. the move was noticed while another refresh was running
+        self.scheduler.mark_refreshed(HERE)
+        self.assertTrue(self.scheduler.check(ELSEWHERE))
+        self.assertTrue(self.scheduler.check(ELSEWHERE))
+        self.scheduler.mark_refreshed(ELSEWHERE)
+        self.assertFalse(self.scheduler.check(ELSEWHERE))
+
+    def test_refreshes_after_max_refresh_interval_without_moving(self):
+        self.scheduler.mark_refreshed(HERE)
+        self.scheduler.last_refresh = time.time() - 301
+        self.assertTrue(self.scheduler.check(HERE))
+
+    def test_mark_refreshed_without_signals_keeps_the_reference(self):
+        self.scheduler.mark_refreshed(HERE)
+        self.scheduler.mark_refreshed()
+        self.assertEqual(self.scheduler.reference, HERE)
+
+
+if __name__ == '__main__':
+    unittest.main()
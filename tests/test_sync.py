@@ -0,0 +1,117 @@
+import json
+import unittest
+
+import support
+import client_api
+import sync
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.headers = headers or dict()
+
+
+class FakeTransport(object):
+    """Answers each GET with the next of `responses`, remembering the
+    parameters and headers it was sent."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = list()
+
+    def get(self, url, params=None, headers=None, cookies=None):
+        self.requests.append((params, headers))
+        return self.responses.pop(0)
+
+
+def place(identifier, alias):
+    return {'id': identifier, 'alias': alias, 'floor': 'EH4', 'name': alias}
+
+
+class ReplicaTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.settings_directory = support.init_temporary_settings()
+
+    @classmethod
+    def tearDownClass(cls):
+        support.remove_temporary_settings(cls.settings_directory)
+
+    def setUp(self):
+        self.replica = sync.Replica('places', client_api.Place)
+        self.get_transport = sync.get_transport
+
+    def tearDown(self):
+        sync.get_transport = self.get_transport
+
+    def serve(self, *responses):
+        transport = FakeTransport(*responses)
+        sync.get_transport = lambda: transport
+        return transport
+
+    def aliases(self):
+        return dict((p.id, p.alias) for p in self.replica.values())
+
+    def test_delta_is_merged_in_place(self):
+        transport = self.serve(
+            FakeResponse(200, {'places': [place(1, 'lounge'),
+                                          place(2, 'kitchen'),
+                                          place(3, 'library')],
+                               'cursor': 'c1'}),
+            FakeResponse(200, {'places': [place(2, 'galley'),
+                                          place(4, 'gym')],
+                               'deleted': [3],
+                               'since': 'c1', 'cursor': 'c2'}))
+        self.assertTrue(self.replica.refresh())
+        lounge = self.replica.get(1)
+        version = self.replica.version
+        self.assertTrue(self.replica.refresh())
+        self.assertEqual(transport.requests[1][0], {'since': 'c1'})
+        self.assertEqual(self.aliases(),
+                         {1: 'lounge', 2: 'galley', 4: 'gym'})
+        # Untouched records are the same objects
+        self.assertTrue(self.replica.get(1) is lounge)
+        self.assertEqual(self.replica.version, version + 1)
+
+    def test_full_answer_replaces_the_replica(self):
+        # i.e. the server ignored `since`
+        self.serve(
+            FakeResponse(200, {'places': [place(1, 'lounge'),
+                                          place(2, 'kitchen')],
+                               'cursor': 'c1'}),
+            FakeResponse(200, {'places': [place(2, 'kitchen')],
+                               'cursor': 'c2'}))
+        self.replica.refresh()
+        self.assertTrue(self.replica.refresh())
+        self.assertEqual(self.aliases(), {2: 'kitchen'})
+
+    def test_unchanged_delta_is_not_a_change(self):
+        self.serve(
+            FakeResponse(200, {'places': [place(1, 'lounge')],
+                               'cursor': 'c1'}),
+            FakeResponse(200, {'places': [place(1, 'lounge')],
+                               'deleted': [7],
+                               'since': 'c1', 'cursor': 'c2'}))
+        self.replica.refresh()
+        version = self.replica.version
+        self.assertFalse(self.replica.refresh())
+        self.assertEqual(self.replica.version, version)
+
+    def test_not_modified_sends_validators_and_keeps_the_records(self):
+        transport = self.serve(
+            FakeResponse(200, {'places': [place(1, 'lounge')]},
+                         headers={'etag': '"v1"'}),
+            FakeResponse(304))
+        self.replica.refresh()
+        self.assertFalse(self.replica.refresh())
+        self.assertEqual(transport.requests[1][1],
+                         {'If-None-Match': '"v1"'})
+        self.assertEqual(self.aliases(), {1: 'lounge'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import support
+import unixsocket
+
+
+@unittest.skipIf(not hasattr(socket, 'AF_UNIX'), "Needs Unix sockets")
+class LineServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_answers_every_line(self):
+        server = unixsocket.LineServer(self.path,
+                                       lambda line: {'echo': line}).start()
+        try:
+            self.assertEqual(unixsocket.send_line(self.path, 'status'),
+                             {'echo': 'status'})
+        finally:
+            server.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_replaces_a_left_over_socket(self):
+        left_over = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        left_over.bind(self.path)
+        left_over.close()
+        server = unixsocket.LineServer(self.path, lambda line: 1).start()
+        try:
+            self.assertEqual(unixsocket.send_line(self.path, 'x'), 1)
+        finally:
+            server.close()
+
+    def test_keeps_the_socket_of_a_running_server(self):
+        server = unixsocket.LineServer(self.path, lambda line: 1).start()
+        try:
+            self.assertRaises(unixsocket.Socket_In_Use_Error,
+                              unixsocket.LineServer, self.path,
+                              lambda line: 2)
+            self.assertEqual(unixsocket.send_line(self.path, 'x'), 1)
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()